@@ -1,40 +1,312 @@
+import hmac
 import os
 from dotenv import load_dotenv
+import json
+from datetime import timedelta
 from flask import (
-    Flask, render_template, request, flash, redirect, session, g, abort, jsonify
+    Flask, Blueprint, render_template, request, flash, redirect, session, g,
+    abort, jsonify, Response, stream_with_context, current_app
 )
-from models import User, Message, Friendship, db, connect_db
+from models import (
+    User, Message, Conversation, Friendship, FriendshipError, db, connect_db,
+    hasher, init_extensions, pubsub, replica_router, select_serialized,
+    select_version, user_cache
+)
+from commands import (
+    add_read_receipts, add_row_versions, add_upload_jobs, compact_friendships,
+    create_search_index, rebuild_conversations
+)
+from datagen import generate_data
+import dbpool
+import metrics
+import profiling
+from replicas import read_only
+from hashing import HashingBusy
+from ratelimit import RateLimited, RateLimiter, rate_limit, retry_after_header
+from pagination import PaginationError, parse_limit
+from serialization import dumps, records, respond
+from search import (
+    message_search, search_messages, search_users, user_search
+)
+from conditional import conditional, make_etag
+from geo import get_zip_index
 from flask_jwt_extended import create_access_token
 from flask_jwt_extended import get_jwt_identity
 from flask_jwt_extended import get_jwt
+from flask_jwt_extended import get_jwt_request_location
 from flask_jwt_extended import jwt_required
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
-import boto3
-from io import BytesIO
-
-s3 = boto3.client('s3')
+from werkzeug.middleware.proxy_fix import ProxyFix
+from uploads import FilesystemStorage, PhotoPipeline, S3Storage, photo_key
 
 load_dotenv()
 
-app = Flask(__name__)
-CORS(app)
-jwt = JWTManager(app)
-
-app.config["JWT_ACCESS_TOKEN_EXPIRES"] = False
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-app.config['SQLALCHEMY_ECHO'] = False
-#app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-#toolbar = DebugToolbarExtension(app)
-app.config['UPLOAD_FOLDER'] = "./temp"
-app.config["JWT_SECRET_KEY"] = "super-secret" # TODO: Update .env
-
 BUCKET_NAME = "friender-rithm-terrysli"
 #BUCKET_NAME = "friender-may-2023"
 BUCKET_PUBLIC_PATH = "profile_photos"
+# Signs access tokens unless JWT_SECRET_KEY is set (asgi.py uses the same)
+DEFAULT_JWT_SECRET_KEY = "super-secret" # TODO: Update .env
+
+api = Blueprint("api", __name__)
+jwt = JWTManager()
+
+
+def create_app(config=None):
+    """Create and configure the Friender app.
+
+    Settings come from the environment, overridden by 'config'. Heavy
+    integrations (the boto3 client, Pillow, the hashing pool, the zip index)
+    are only set up on first use, so creating an app stays cheap for every
+    server worker, CLI command and test.
+    """
+
+    app = Flask(__name__)
+
+    app.config["JWT_ACCESS_TOKEN_EXPIRES"] = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    app.config['SQLALCHEMY_ECHO'] = False
+    # "queue" pools connections in each process; "pgbouncer" opens one per
+    # checkout (NullPool) for use behind pgbouncer in transaction mode
+    app.config["DB_POOL_MODE"] = os.environ.get("DB_POOL_MODE", "queue")
+    app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", 5))
+    app.config["DB_MAX_OVERFLOW"] = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+    app.config["DB_POOL_TIMEOUT"] = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+    app.config["DB_POOL_RECYCLE"] = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    app.config["DB_POOL_PRE_PING"] = \
+        os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+    # Comma-separated replica URLs that read-only GET routes query instead
+    app.config["DB_REPLICA_URLS"] = [
+        url for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url]
+    # "round_robin", or "least_loaded" for the fewest checked out connections
+    app.config["DB_REPLICA_SELECTION"] = os.environ.get(
+        "DB_REPLICA_SELECTION", "round_robin")
+    # Seconds a client stays on the primary after writing
+    app.config["DB_REPLICA_STICKY_SECONDS"] = float(
+        os.environ.get("DB_REPLICA_STICKY_SECONDS", 5))
+    #app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    #toolbar = DebugToolbarExtension(app)
+    app.config['UPLOAD_FOLDER'] = os.environ.get("UPLOAD_FOLDER", "./temp")
+    # "s3", or "filesystem" to store photos under UPLOAD_FOLDER instead
+    app.config["UPLOAD_BACKEND"] = os.environ.get("UPLOAD_BACKEND", "s3")
+    # Defaults to UPLOAD_FOLDER's file:// URL, derived once overrides apply
+    app.config["UPLOAD_BASE_URL"] = os.environ.get("UPLOAD_BASE_URL")
+    app.config["UPLOAD_WORKERS"] = int(os.environ.get("UPLOAD_WORKERS", 2))
+    app.config["S3_BUCKET"] = os.environ.get("S3_BUCKET", BUCKET_NAME)
+    # Limits for photos uploaded straight to S3 with a presigned POST
+    app.config["PHOTO_MAX_BYTES"] = int(os.environ.get("PHOTO_MAX_BYTES", 5 * 1024 * 1024))
+    app.config["PHOTO_PRESIGN_EXPIRES"] = int(os.environ.get("PHOTO_PRESIGN_EXPIRES", 300))
+    app.config["JWT_SECRET_KEY"] = os.environ.get(
+        "JWT_SECRET_KEY", DEFAULT_JWT_SECRET_KEY)
+    app.config["ZIP_COORDINATES_FILE"] = os.environ.get(
+        "ZIP_COORDINATES_FILE", os.path.join(app.root_path, "data", "zip_coordinates.csv"))
+
+    app.config["BCRYPT_LOG_ROUNDS"] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+    app.config["HASH_POOL_WORKERS"] = int(
+        os.environ.get("HASH_POOL_WORKERS", os.cpu_count() or 1))
+    # Defaults to 4 x HASH_POOL_WORKERS (see hashing.py), after overrides
+    if "HASH_POOL_MAX_PENDING" in os.environ:
+        app.config["HASH_POOL_MAX_PENDING"] = int(os.environ["HASH_POOL_MAX_PENDING"])
+
+    app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", 10000))
+    app.config["USER_CACHE_TTL"] = float(os.environ.get("USER_CACHE_TTL", 30))
+    # Serve GET /users/<username> from the user cache (may be up to TTL stale
+    # when another worker changed the user)
+    app.config["USER_CACHE_FAST_PATH"] = \
+        os.environ.get("USER_CACHE_FAST_PATH", "false").lower() == "true"
+
+    # Seconds between reloads of the in-memory friendship graph, which
+    # otherwise only sees this process's own friendship changes
+    app.config["SUGGESTIONS_REFRESH_SECONDS"] = float(
+        os.environ.get("SUGGESTIONS_REFRESH_SECONDS", 300))
+
+    app.config["BULK_MESSAGES_MAX"] = int(os.environ.get("BULK_MESSAGES_MAX", 5000))
+    app.config["PUBSUB_URL"] = os.environ.get("PUBSUB_URL", "memory://")
+    # Seconds between SSE keep-alive comments on an idle event stream
+    app.config["EVENTS_KEEPALIVE"] = float(os.environ.get("EVENTS_KEEPALIVE", 15))
+    # Seconds a stream token (the ?jwt= of an event stream URL) is valid for
+    app.config["STREAM_TOKEN_EXPIRES"] = int(os.environ.get("STREAM_TOKEN_EXPIRES", 60))
+
+    # Bearer token Prometheus must send to scrape /metrics, if set
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+    # Share of requests whose SQL is timed (Server-Timing header and a
+    # "profiling" log line), and the ms over which a statement is explained
+    app.config["QUERY_PROFILE_SAMPLE_RATE"] = float(
+        os.environ.get("QUERY_PROFILE_SAMPLE_RATE", 0))
+    app.config["QUERY_PROFILE_TOP"] = int(os.environ.get("QUERY_PROFILE_TOP", 3))
+    app.config["QUERY_PROFILE_SLOW_MS"] = float(
+        os.environ.get("QUERY_PROFILE_SLOW_MS", 100))
+
+    # Token-bucket budgets for message and friend request writes, per JWT
+    # identity (or IP). Use an "mmap:///path" store to share them between
+    # gunicorn workers (gunicorn.conf.py does by default)
+    app.config["RATELIMIT_ENABLED"] = (
+        os.environ.get("RATELIMIT_ENABLED", "true").lower() == "true")
+    app.config["RATELIMIT_STORAGE_URL"] = os.environ.get(
+        "RATELIMIT_STORAGE_URL", "memory://")
+    # Reverse proxies (load balancer, nginx) in front of the app. Anonymous
+    # rate limit buckets and replica stickiness key on the client's IP, which
+    # is then read from X-Forwarded-For; left at 0 behind a proxy, every
+    # client shares the proxy's address and so one budget
+    app.config["TRUSTED_PROXY_HOPS"] = int(os.environ.get("TRUSTED_PROXY_HOPS", 0))
+    app.config["RATELIMITS"] = {
+        "messages": os.environ.get("RATELIMIT_MESSAGES", "60/minute"),
+        # Per message sent through /messages/bulk; the burst also caps a batch
+        "messages_bulk": os.environ.get("RATELIMIT_MESSAGES_BULK", "10000/hour"),
+        "friendships": os.environ.get("RATELIMIT_FRIENDSHIPS", "20/minute"),
+    }
+
+    app.config.update(config or {})
+
+    # Settings derived from others, so they follow overridden values
+    if not app.config["UPLOAD_BASE_URL"]:
+        app.config["UPLOAD_BASE_URL"] = \
+            "file://" + os.path.abspath(app.config["UPLOAD_FOLDER"])
+
+    hops = app.config["TRUSTED_PROXY_HOPS"]
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+
+    CORS(app)
+    jwt.init_app(app)
+    RateLimiter(app)
+    dbpool.init_app(app)
+    profiling.init_app(app)
+    metrics.init_app(app)
+    init_extensions(app)
+    connect_db(app)
+
+    if app.config["UPLOAD_BACKEND"] == "filesystem":
+        photo_storage = FilesystemStorage(
+            app.config["UPLOAD_FOLDER"], app.config["UPLOAD_BASE_URL"])
+    else:
+        photo_storage = S3Storage(app.config["S3_BUCKET"])
+
+    app.extensions["photos"] = PhotoPipeline(app, photo_storage, BUCKET_PUBLIC_PATH,
+        workers=app.config["UPLOAD_WORKERS"])
+
+    app.cli.add_command(rebuild_conversations)
+    app.cli.add_command(add_row_versions)
+    app.cli.add_command(add_read_receipts)
+    app.cli.add_command(add_upload_jobs)
+    app.cli.add_command(compact_friendships)
+    app.cli.add_command(create_search_index)
+    app.cli.add_command(generate_data)
+    app.register_blueprint(api)
+
+    return app
+
+
+def get_photos():
+    """Return the current app's PhotoPipeline"""
+
+    return current_app.extensions["photos"]
+
+
+def conditional_page(query, model, build):
+    """Return build()'s response for a list of model rows, or 304 if the
+    rows 'query' selects haven't changed since the client fetched them"""
+
+    count, updated_at, first, last = db.session.execute(
+        select_version(query, model)).one()
+    etag = make_etag(request.full_path, count, updated_at, first, last)
+
+    return conditional(build, etag, updated_at)
+
+
+@jwt.user_lookup_loader
+def load_user(jwt_header, jwt_data):
+    """Load the token's user from the user cache.
+
+    Tokens of deleted users then fail verification, without a DB round trip
+    once the miss is cached.
+    """
+
+    return User.get_cached(jwt_data["sub"])
+
+
+@jwt.token_verification_loader
+def check_token_scope(jwt_header, jwt_data):
+    """Stream tokens, which end up in URLs and logs, only open event
+    streams"""
+
+    return not jwt_data.get("stream") or request.endpoint == "api.stream_user_events"
+
+
+@api.app_errorhandler(HashingBusy)
+def hashing_busy(e):
+    """Shed load when the password hashing pool is saturated"""
+
+    return jsonify({"Error": "Server busy, try again"}), 503, {"Retry-After": "1"}
+
+
+@api.app_errorhandler(RateLimited)
+def rate_limited(e):
+    """Refuse writes over the client's budget until a token refills"""
+
+    if e.retry_after is None:
+        return jsonify({"Error": "Too many messages at once for the rate limit"}), 429
 
-connect_db(app)
+    return jsonify({"Error": "Too many requests, try again later"}), 429, {
+        "Retry-After": retry_after_header(e.retry_after)}
+
+
+@api.app_errorhandler(FriendshipError)
+def friendship_error(e):
+    """Reject disallowed friend requests and status changes"""
+
+    return jsonify({"Error": str(e)}), 400
+
+
+def messages_response(username=None):
+    """Return a keyset-paginated page of messages as JSON.
+
+    Query args: 'after' is the 'next_cursor' of the previous page and 'limit'
+    the page size. Clients sending 'Accept: application/x-ndjson' instead get
+    every matching message streamed one JSON object per line ('limit' is then
+    optional). JSON pages answer conditional requests (see conditional_page).
+    """
+
+    after = request.args.get("after")
+    ndjson = request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+    fields = Message.serialized_columns
+
+    try:
+        if ndjson:
+            limit = request.args.get("limit")
+            query = select_serialized(
+                Message.select_after(
+                    username=username, after=after,
+                    limit=parse_limit(limit) if limit is not None else None),
+                Message, Message.timestamp)
+            rows = db.session.execute(query.execution_options(yield_per=1000))
+        else:
+            limit = parse_limit(request.args.get("limit"))
+            query = select_serialized(
+                Message.select_after(username=username, after=after, limit=limit + 1),
+                Message, Message.timestamp)
+    except PaginationError as e:
+        return jsonify({"Error": str(e)}), 400
+
+    if ndjson:
+        def generate():
+            for row in rows:
+                yield dumps(dict(zip(fields, row))) + b"\n"
+
+        return Response(
+            stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    def build():
+        page = db.session.execute(query).all()
+        next_cursor = Message.cursor(page[limit - 1]) if len(page) > limit else None
+
+        return respond({"messages": records(page[:limit], fields),
+                        "next_cursor": next_cursor})
+
+    return conditional_page(query, Message, build)
 
 
 def get_token(user):
@@ -48,7 +320,7 @@ def get_token(user):
 
 ########## /auth routes
 
-@app.route("/auth/login", methods=["POST"])
+@api.route("/auth/login", methods=["POST"])
 def login():
     """Log in user and return access token if valid username/password,
     otherwise return error message"""
@@ -58,43 +330,113 @@ def login():
 
     user = User.authenticate(username, password)
     if user:
+        # Saves the upgraded hash if authenticate rehashed the password
+        db.session.commit()
         token = get_token(user)
         return jsonify(token=token)
     else:
         return jsonify({"Error": "Invalid username/password"}), 401
 
 
+########## /stats routes
+
+@api.route("/stats/hashing", methods=["GET"])
+@jwt_required()
+def show_hashing_stats():
+    """Returns password hashing pool queue depth and counters (ADMIN ONLY)"""
+
+    claims = get_jwt()
+    if claims["is_admin"] == True:
+        return jsonify(hashing=hasher.stats())
+
+    return jsonify({"Error": "This route is admin-protected"}), 401
+
+
+@api.route("/stats/cache", methods=["GET"])
+@jwt_required()
+def show_cache_stats():
+    """Returns user cache hit/miss counters (ADMIN ONLY)"""
+
+    claims = get_jwt()
+    if claims["is_admin"] == True:
+        return jsonify(user_cache=user_cache.stats())
+
+    return jsonify({"Error": "This route is admin-protected"}), 401
+
+
+@api.route("/stats/db", methods=["GET"])
+@jwt_required()
+def show_db_stats():
+    """Returns connection pool occupancy and checkout waits (ADMIN ONLY)"""
+
+    claims = get_jwt()
+    if claims["is_admin"] == True:
+        return jsonify(pool=dbpool.pool_status(db.engine),
+                       checkout=dbpool.pool_stats.snapshot(),
+                       replicas=replica_router.stats(db.engines))
+
+    return jsonify({"Error": "This route is admin-protected"}), 401
+
+
+# GET Prometheus metrics (bearer METRICS_TOKEN, when set)
+@api.route("/metrics", methods=["GET"])
+def show_metrics():
+    """Returns metrics in the Prometheus text format"""
+
+    token = current_app.config["METRICS_TOKEN"]
+    if token and not hmac.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
 ########## /users routes
 
 # GET all users (ADMIN ONLY)
-@app.route("/users", methods=["GET"])
+@api.route("/users", methods=["GET"])
 @jwt_required()
+@read_only
 def show_all_users():
     """Returns all users"""
 
     claims = get_jwt()
     if claims["is_admin"] == True:
-        users = User.all()
-        serialized = [u.serialize() for u in users]
-        return jsonify(users=serialized)
+        def build():
+            rows = db.session.execute(
+                select_serialized(User.select_all(), User)).all()
+            return respond({"users": records(rows, User.serialized_columns)})
+
+        return conditional_page(User.select_all(), User, build)
 
     return jsonify({"Error": "This route is admin-protected"}), 401
 
 
 # GET user by username (admin/loggedin/sameuser/friend?) TODO: need to block rejected connections
-@app.route("/users/<username>")
+@api.route("/users/<username>")
 @jwt_required()
+@read_only
 def get_user_by_username(username):
     """Returns given user"""
 
+    if current_app.config["USER_CACHE_FAST_PATH"]:
+        serialized = User.get_cached(username)
+        if serialized is None:
+            abort(404)
+
+        # Cached entries carry no version, so tag the content itself
+        return conditional(
+            lambda: jsonify(user=serialized), make_etag(serialized))
+
     user = User.get(username)
-    serialized = user.serialize()
 
-    return jsonify(user=serialized)
+    return conditional(lambda: jsonify(user=user.serialize()),
+        make_etag(user.username, user.updated_at), user.updated_at)
 
 
 # POST create new user (register) TODO: Validate info before making new user
-@app.route("/users", methods=["POST"])
+@api.route("/users", methods=["POST"])
 def create_new_user():
     """Creates new user"""
 
@@ -124,7 +466,7 @@ def create_new_user():
 
 
 # PATCH edit user (TODO: add middleware for admin/loggedin/sameuser)
-@app.route("/users/<username>", methods=["PATCH"])
+@api.route("/users/<username>", methods=["PATCH"])
 @jwt_required()
 def update_user(username):
     """Update user data"""
@@ -145,7 +487,7 @@ def update_user(username):
 
 
 # DELETE user (TODO: add middleware for admin/loggedin/sameuser)
-@app.route("/users/<username>", methods=["DELETE"])
+@api.route("/users/<username>", methods=["DELETE"])
 @jwt_required()
 def delete_user(username):
     """Delete a user"""
@@ -162,57 +504,373 @@ def delete_user(username):
     return jsonify({"Error": "Unauthorized"}), 401
 
 # GET friends of user TODO: Add middleware for same user/admin/loggedin
-@app.route("/users/<username>/friends", methods=["GET"])
+@api.route("/users/<username>/friends", methods=["GET"])
+@read_only
 def get_friends_for_user(username):
-    """Returns array of friends for user"""
+    """Returns page of friends for user.
+
+    Takes 'after' (the previous page's 'next_cursor') and 'limit' query args.
+    """
 
-    friends = User.friends(username)
-    serialized = [f.serialize() for f in friends]
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        query = User.select_friends(
+            username, after=request.args.get("after"), limit=limit + 1)
+    except PaginationError as e:
+        return jsonify({"Error": str(e)}), 400
+
+    def build():
+        friends = db.session.execute(select_serialized(query, User)).all()
+        next_cursor = User.cursor(friends[limit - 1]) \
+            if len(friends) > limit else None
+
+        return respond({
+            "friends": records(friends[:limit], User.serialized_columns),
+            "next_cursor": next_cursor})
+
+    return conditional_page(query, User, build)
 
-    return jsonify(friends=serialized)
+
+# GET users within friend_radius of user, excluding existing friendships
+@api.route("/users/<username>/nearby", methods=["GET"])
+@jwt_required()
+@read_only
+def get_nearby_users(username):
+    """Returns page of users within the user's friend_radius (miles).
+
+    Takes 'after' (the previous page's 'next_cursor') and 'limit' query args.
+    Each user includes their distance in miles.
+    """
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
+
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    user = User.get(username)
+    zip_index = get_zip_index(current_app.config["ZIP_COORDINATES_FILE"])
+    distances = zip_index.within(user.location, user.friend_radius)
+
+    if not distances:
+        return jsonify({"Error": f"Unknown location {user.location}"}), 400
+
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        query = User.select_nearby(
+            username, distances, after=request.args.get("after"), limit=limit + 1)
+    except PaginationError as e:
+        return jsonify({"Error": str(e)}), 400
+
+    nearby = db.session.execute(select_serialized(query, User)).all()
+    next_cursor = User.cursor(nearby[limit - 1]) \
+        if len(nearby) > limit else None
+    serialized = records(nearby[:limit], User.serialized_columns)
+    for u in serialized:
+        u["distance"] = round(distances[u["location"]], 1)
+
+    return respond({"users": serialized, "next_cursor": next_cursor})
+
+
+# GET friend-of-friend suggestions for user
+@api.route("/users/<username>/suggestions", methods=["GET"])
+@jwt_required()
+@read_only
+def get_friend_suggestions(username):
+    """Returns users to befriend, ranked by mutual friends.
+
+    Takes a 'limit' query arg. With 'nearby=true', users within the user's
+    friend_radius rank higher the closer they are, and include their
+    distance in miles.
+    """
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
+
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    try:
+        limit = parse_limit(request.args.get("limit"))
+    except PaginationError as e:
+        return jsonify({"Error": str(e)}), 400
+
+    distances = radius = None
+    if request.args.get("nearby", "false").lower() == "true":
+        user = User.get(username)
+        zip_index = get_zip_index(current_app.config["ZIP_COORDINATES_FILE"])
+        distances = zip_index.within(user.location, user.friend_radius)
+        radius = user.friend_radius
+
+    suggestions = User.suggestions(
+        username, limit=limit, distances=distances, radius=radius)
+
+    return respond({"suggestions": suggestions})
 
 
 # GET messages either sent or received by user
-@app.route("/users/<username>/messages", methods=["GET"])
+@api.route("/users/<username>/messages", methods=["GET"])
+@read_only
 def get_user_messages(username):
-    """Return array of messages involving user"""
+    """Return page of messages involving user (see messages_response)"""
+
+    return messages_response(username=username)
+
+
+# GET user's conversations, most recent first
+@api.route("/users/<username>/conversations", methods=["GET"])
+@jwt_required()
+@read_only
+def get_user_conversations(username):
+    """Returns page of conversations with their latest message.
+
+    Takes 'after' (the previous page's 'next_cursor') and 'limit' query args.
+    """
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
 
-    messages = User.messages(username)
-    serialized = [m.serialize() for m in messages]
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        conversations = Conversation.for_user(
+            username, after=request.args.get("after"), limit=limit + 1)
+    except PaginationError as e:
+        return jsonify({"Error": str(e)}), 400
 
-    return jsonify(messages=serialized)
+    next_cursor = Conversation.cursor(conversations[limit - 1]) \
+        if len(conversations) > limit else None
+    serialized = [c.serialize() for c in conversations[:limit]]
+
+    return jsonify(conversations=serialized, next_cursor=next_cursor)
+
+
+# GET messages between two users, newest first
+@api.route("/users/<username>/conversations/<other>", methods=["GET"])
+@jwt_required()
+@read_only
+def get_conversation(username, other):
+    """Returns page of messages between username and other, newest first.
+
+    Takes 'after' (the previous page's 'next_cursor') and 'limit' query args.
+    """
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
+
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        messages = Message.thread(
+            username, other, after=request.args.get("after"), limit=limit + 1)
+    except PaginationError as e:
+        return jsonify({"Error": str(e)}), 400
+
+    next_cursor = Message.cursor(messages[limit - 1]) \
+        if len(messages) > limit else None
+    serialized = [
+        dict(m.serialize(), read_at=m.read_at.isoformat() if m.read_at else None)
+        for m in messages[:limit]]
+
+    return jsonify(messages=serialized, next_cursor=next_cursor)
+
+
+# POST mark messages from other to user read
+@api.route("/users/<username>/conversations/<other>/read", methods=["POST"])
+@jwt_required()
+def mark_conversation_read(username, other):
+    """Marks user's unread messages from other read (read receipts).
+
+    Takes an optional JSON 'up_to' message id to only mark messages up to
+    it; returns how many were marked.
+    """
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
+
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    up_to = (request.get_json(silent=True) or {}).get("up_to")
+    if up_to is not None and not isinstance(up_to, int):
+        return jsonify({"Error": "up_to must be a message id"}), 400
+
+    marked = Conversation.mark_read(username, other, up_to=up_to)
+    db.session.commit()
+
+    return jsonify(marked_read=marked)
+
+
+# GET unread counts per conversation for user
+@api.route("/users/<username>/inbox/summary", methods=["GET"])
+@jwt_required()
+@read_only
+def get_inbox_summary(username):
+    """Returns user's total unread messages and, per conversation with any,
+    the other user, unread count and latest message, most recent first"""
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
+
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    conversations = Conversation.unread_summary(username)
+
+    return jsonify(unread=sum(c["unread"] for c in conversations),
+                   conversations=conversations)
+
+
+# POST get a short-lived token for opening the user's event stream
+@api.route("/users/<username>/events/token", methods=["POST"])
+@jwt_required()
+def create_stream_token(username):
+    """Returns a token that only opens the user's event stream and expires
+    after STREAM_TOKEN_EXPIRES seconds, for passing as '?jwt=<token>'"""
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
+
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    token = create_access_token(
+        identity=identity,
+        additional_claims={"is_admin": claims["is_admin"], "stream": True},
+        expires_delta=timedelta(seconds=current_app.config["STREAM_TOKEN_EXPIRES"]))
+    return jsonify(token=token)
+
+
+# GET stream of new messages and friendship changes for user
+@api.route("/users/<username>/events", methods=["GET"])
+@jwt_required(locations=["headers", "query_string"])
+def stream_user_events(username):
+    """Stream the user's new messages and friendship changes (Server-Sent
+    Events).
+
+    Each event is named "message", "friendship" or "upload" (a photo upload
+    job that finished) with the serialized record as data. Browsers' EventSource can't set headers, so a stream
+    token from POST /users/<username>/events/token may be passed as
+    '?jwt=<token>' instead; ordinary tokens never expire, so they are only
+    accepted in the Authorization header. Fetch a fresh stream token before
+    each (re)connect.
+
+    A stream holds its request thread while the client is connected: serve
+    it from a threaded server (gunicorn.conf.py's gthread workers, sized by
+    GUNICORN_THREADS), never from sync workers.
+    """
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
+
+    if get_jwt_request_location() == "query_string" and not claims.get("stream"):
+        return jsonify({"Error": "Pass a stream token as ?jwt="}), 401
+
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    subscription = pubsub.subscribe([username])
+    keepalive = current_app.config["EVENTS_KEEPALIVE"]
+
+    def generate():
+        try:
+            yield ": connected\n\n"
+            while True:
+                event = subscription.get(timeout=keepalive)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            subscription.close()
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+########## /search routes
+
+@api.route("/search", methods=["GET"])
+@jwt_required(optional=True)
+@read_only
+def search():
+    """Returns a page of full-text search results for 'q', best first.
+
+    'type' is "users" (default; matches bios) or "messages" (matches the
+    texts of the logged-in user's own messages). Takes 'after' (the previous
+    page's 'next_cursor') and 'limit' query args.
+    """
+
+    q = request.args.get("q", "").strip()
+    type = request.args.get("type", "users")
+
+    if not q:
+        return jsonify({"Error": "q is required"}), 400
+
+    if type == "messages":
+        identity = get_jwt_identity()
+        if identity is None:
+            return jsonify({"Error": "Unauthorized"}), 401
+    elif type != "users":
+        return jsonify({"Error": f"Unknown search type: {type}"}), 400
+
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        after = request.args.get("after")
+        if type == "users":
+            index = user_search
+            results = search_users(q, after=after, limit=limit + 1)
+        else:
+            index = message_search
+            results = search_messages(q, identity, after=after, limit=limit + 1)
+    except PaginationError as e:
+        return jsonify({"Error": str(e)}), 400
+
+    next_cursor = index.cursor(results[limit - 1]) \
+        if len(results) > limit else None
+    serialized = records(results[:limit], index.model.serialized_columns)
+    for result, row in zip(serialized, results):
+        result["rank"] = row.rank
+
+    return respond({type: serialized, "next_cursor": next_cursor})
 
 
 ########## /messages routes
 
-@app.route("/messages", methods=["GET"])
+@api.route("/messages", methods=["GET"])
 #@jwt_required()
+@read_only
 def get_all_messages():
     """Return data on all messages"""
 
     # claims = get_jwt()
 
     # if claims["is_admin"] == True:
-    messages = Message.all()
-    serialized = [m.serialize() for m in messages]
-
-    return jsonify(messages=serialized)
+    return messages_response()
 
     return jsonify({"Error": "Unauthorized"}), 401
 
 
 # NOTE: needed?
-@app.route("/messages/<int:message_id>", methods=["GET"])
+@api.route("/messages/<int:message_id>", methods=["GET"])
+@read_only
 def get_message_by_id(message_id):
     """Returns a message of a given id"""
 
 
     message = Message.get(message_id)
-    serialized = message.serialize()
 
-    return jsonify(message=serialized)
+    return conditional(lambda: jsonify(message=message.serialize()),
+        make_etag(message.id, message.updated_at), message.updated_at)
 
-@app.route("/messages", methods=["POST"])
+@api.route("/messages", methods=["POST"])
+@rate_limit("messages")
 def create_new_message():
     """Create a new message"""
 
@@ -227,30 +885,75 @@ def create_new_message():
 
     return jsonify(message=serialized)
 
+@api.route("/messages/bulk", methods=["POST"])
+def create_messages_in_bulk():
+    """Create many messages at once.
+
+    Takes a JSON array of {from_user, to_user, text} (or {"messages": [...]})
+    and returns a result per item, in order: its new id or an error. Invalid
+    items don't prevent the rest being created.
+    """
+
+    data = request.json
+    items = data.get("messages") if isinstance(data, dict) else data
+
+    if not isinstance(items, list):
+        return jsonify({"Error": "Expected an array of messages"}), 400
+
+    limiter = current_app.extensions["rate_limiter"]
+    max_items = limiter.max_cost("messages_bulk", current_app.config["BULK_MESSAGES_MAX"])
+    if len(items) > max_items:
+        return jsonify({"Error": f"At most {max_items} messages per request"}), 413
+
+    # Only messages that will be created spend from the bulk budget
+    results, valid = Message.validate_many(items)
+    if valid:
+        limiter.spend("messages_bulk", len(valid))
+
+    Message.insert_many(results, valid)
+    db.session.commit()
+
+    created = [r["id"] for r in results if "id" in r]
+    errors = [dict(r, index=i) for i, r in enumerate(results) if "Error" in r]
+
+    if not errors:
+        status = 201
+    elif created:
+        status = 207
+    else:
+        status = 400
+
+    return jsonify(created=created, errors=errors), status
+
 ####### /friendships
 
-@app.route("/friendships", methods=["GET"])
+@api.route("/friendships", methods=["GET"])
+@read_only
 def get_all_friendships():
     """Get all friendship data"""
 
-    friendships = Friendship.all()
+    def build():
+        friendships = db.session.execute(
+            select_serialized(Friendship.select_all(), Friendship)).all()
 
-    serialized = [f.serialize() for f in friendships]
+        return respond(
+            {"friendships": records(friendships, Friendship.serialized_columns)})
 
-    return jsonify(friendships=serialized)
+    return conditional_page(Friendship.select_all(), Friendship, build)
 
-@app.route("/friendships/<int:friendship_id>", methods=["GET"])
+@api.route("/friendships/<int:friendship_id>", methods=["GET"])
+@read_only
 def get_friendship_by_id(friendship_id):
     """Get friendship data by id"""
 
     friendship = Friendship.get(friendship_id)
 
-    serialized = friendship.serialize()
+    return conditional(lambda: jsonify(friendship=friendship.serialize()),
+        make_etag(friendship.id, friendship.updated_at), friendship.updated_at)
 
-    return jsonify(friendship=serialized)
 
-
-@app.route("/friendships", methods=["POST"])
+@api.route("/friendships", methods=["POST"])
+@rate_limit("friendships")
 def send_friend_request():
     """Create new friendship request"""
 
@@ -264,7 +967,7 @@ def send_friend_request():
 
     return jsonify(friendship=serialized)
 
-@app.route("/friendships/<int:friendship_id>", methods=["PATCH"])
+@api.route("/friendships/<int:friendship_id>", methods=["PATCH"])
 def update_friend_request(friendship_id):
     """Update status of friendship with given id"""
 
@@ -278,33 +981,107 @@ def update_friend_request(friendship_id):
     return jsonify(friendship=serialized)
 
 # Route to upload file to S3
-@app.route('/url_route/<username>', methods=['POST'])
+@api.route('/url_route/<username>', methods=['POST'])
+@jwt_required()
 def upload_file(username):
-    """Handles the upload of a file."""
-    # breakpoint()
-    res = { 'body': "returned file"}
+    """Queue an uploaded profile photo for resizing and storage.
+
+    Returns 202 with the upload job; poll GET /uploads/<job_id> (any
+    server process can answer) until its status is "done", by which point
+    User.photo has been updated, or wait for the "upload" event on the
+    user's event stream.
+    """
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
+
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    file = request.files.get('file_from_react')
+    if file is None:
+        return jsonify({"Error": "Missing file_from_react"}), 400
+
+    photos = get_photos()
+    job_id = photos.submit(username, file)
+
+    return jsonify(upload=photos.status(job_id)), 202
+
+
+# POST get a presigned S3 POST for uploading a profile photo directly
+@api.route('/users/<username>/photo/presign', methods=['POST'])
+@jwt_required()
+def presign_photo_upload(username):
+    """Returns a presigned POST (url + form fields) for uploading the user's
+    photo straight to S3, as a JPEG of at most PHOTO_MAX_BYTES.
+
+    Once the client's POST to S3 succeeds it calls
+    /users/<username>/photo/complete.
+    """
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
+
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    key = photo_key(BUCKET_PUBLIC_PATH, username, "")
+
     try:
-        file = request.files['file_from_react']
-        filename = file.filename
-        # with open(filename, "rb") as f:
-        s3.upload_fileobj(file, BUCKET_NAME, f"{BUCKET_PUBLIC_PATH}/{username}_photo.jpeg", ExtraArgs={
-            "ContentType":"image/jpeg"
-        })
-        # print(f"Uploading file {filename}")
-        # file_bytes = file.read()
-        # file_content = BytesIO(file_bytes).readlines()
-        # print(file_content)
-        res['status'] = 1
-        return jsonify(res=res)
-
-    except Exception as e:
-        print(f"Couldn't upload file {e}")
-        res['body'] = "Error"
-
-
-
-
-# @app.route("/upload", methods=["POST"])
-# def upload_photo():
-#     """Test s3 bucket"""
-#     s3.upload_file("./testphoto.jpg", "friender-rithm-terrysli", "test.photos")
\ No newline at end of file
+        presigned = get_photos().storage.presigned_post(
+            key, "image/jpeg",
+            max_bytes=current_app.config["PHOTO_MAX_BYTES"],
+            expires=current_app.config["PHOTO_PRESIGN_EXPIRES"])
+    except NotImplementedError as e:
+        return jsonify({"Error": str(e)}), 501
+
+    return jsonify(upload=dict(presigned, key=key))
+
+
+# POST record a directly uploaded photo on the user
+@api.route('/users/<username>/photo/complete', methods=['POST'])
+@jwt_required()
+def complete_photo_upload(username):
+    """Checks the user's directly uploaded photo exists and is within limits,
+    then points User.photo at it"""
+
+    claims = get_jwt()
+    identity = get_jwt_identity()
+
+    if claims["is_admin"] != True and identity != username:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    photo_storage = get_photos().storage
+    key = photo_key(BUCKET_PUBLIC_PATH, username, "")
+    stored = photo_storage.head(key)
+
+    if stored is None:
+        return jsonify({"Error": "No uploaded photo found"}), 400
+
+    size, content_type = stored
+    if size > current_app.config["PHOTO_MAX_BYTES"] or content_type != "image/jpeg":
+        return jsonify({"Error": "Uploaded photo is too large or not a JPEG"}), 400
+
+    updated_user = User.update(
+        username=username, data={"photo": photo_storage.url(key)})
+
+    serialized = updated_user.serialize()
+    db.session.commit()
+
+    return jsonify(user=serialized)
+
+
+@api.route('/uploads/<job_id>', methods=['GET'])
+@jwt_required()
+def get_upload_status(job_id):
+    """Returns status of a photo upload job"""
+
+    job = get_photos().status(job_id)
+    if job is None:
+        abort(404)
+
+    claims = get_jwt()
+    if claims["is_admin"] != True and get_jwt_identity() != job["username"]:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    return jsonify(upload=job)
@@ -0,0 +1,387 @@
+"""ASGI variant of the main read routes and the event stream, on
+SQLAlchemy's async engine.
+
+The same models and select builders as the Flask app, queried through an
+AsyncSession (asyncpg on PostgreSQL, aiosqlite on SQLite), in Starlette
+coroutine routes: a request waiting on the database holds no thread, so one
+process can keep thousands of mostly idle connections open.
+
+    uvicorn --factory asgi:create_asgi_app --workers 4
+
+Covers login, the user, friend, message and friendship listings and the
+Server-Sent Events stream, with the same JSON bodies and access rules as
+app.py; tokens from either server work on both (both sign with
+JWT_SECRET_KEY). Event streams are where async pays most: each idle stream
+is a parked coroutine rather than a thread. They see what the WSGI app
+publishes only through a shared broker, so set PUBSUB_URL to Redis.
+
+Everything else (writes, conditional GET, MessagePack) is served by the WSGI
+app only. That includes photo uploads on purpose: they are rare, and bound
+by Pillow resizing and blocking boto3 calls on PhotoPipeline's worker
+threads rather than by idle connections, so an async route would only move
+the same threads behind an await. Large clients should upload straight to
+S3 with the presigned POST routes, which keep file bodies off app servers
+altogether.
+"""
+import json
+import os
+import time
+import uuid
+
+import jwt
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from app import DEFAULT_JWT_SECRET_KEY
+from cache import MISSING, TTLCache
+from hashing import PasswordHasher
+from models import Friendship, Message, User, select_serialized
+from pagination import PaginationError, parse_limit
+from pubsub import create_broker
+from serialization import JSON, dumps, records
+
+JWT_ALGORITHM = "HS256"
+
+# Async drivers for each synchronous database URL scheme
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url):
+    """Return a DATABASE_URL with its driver swapped for an async one"""
+
+    scheme, sep, rest = url.partition("://")
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status, media_type=JSON)
+
+
+def error(message, status):
+    return json_response({"Error": message}, status)
+
+
+def create_token(secret_key, username, is_admin, expires=None, **claims):
+    """Return an access token in flask_jwt_extended's format, valid for
+    'expires' seconds (default: forever) and carrying any extra 'claims'"""
+
+    now = int(time.time())
+    payload = {
+        "fresh": False, "iat": now, "jti": str(uuid.uuid4()), "type": "access",
+        "sub": username, "nbf": now, "is_admin": is_admin, **claims,
+    }
+    if expires is not None:
+        payload["exp"] = now + expires
+
+    return jwt.encode(payload, secret_key, algorithm=JWT_ALGORITHM)
+
+
+async def get_user_cached(request, session, username):
+    """Async User.get_cached: serialized user or None, via the app's user
+    cache"""
+
+    user_cache = request.app.state.user_cache
+    serialized = user_cache.get(username)
+
+    if serialized is MISSING:
+        user = await session.get(User, username)
+        serialized = user.serialize() if user else None
+        user_cache.set(username, serialized)
+
+    return serialized
+
+
+async def current_claims(request, session, stream=False):
+    """Return the request's verified token claims, or None.
+
+    Like @jwt_required, tokens of users that no longer exist are refused,
+    and, as app.check_token_scope, stream tokens only work on event streams
+    ('stream'), which also take them as '?jwt=<token>'.
+    """
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    from_query = not scheme and stream and "jwt" in request.query_params
+    if from_query:
+        scheme, token = "Bearer", request.query_params["jwt"]
+    if scheme != "Bearer":
+        return None
+
+    try:
+        claims = jwt.decode(token, request.app.state.jwt_secret_key,
+                            algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+
+    # Stream tokens open nothing else, and other tokens never go in URLs
+    if claims.get("stream") and not stream or from_query and not claims.get("stream"):
+        return None
+
+    if claims.get("type") != "access" or \
+            await get_user_cached(request, session, claims["sub"]) is None:
+        return None
+
+    return claims
+
+
+async def login(request):
+    """Log in user and return access token if valid username/password"""
+
+    body = await request.json()
+
+    async with request.app.state.sessions() as session:
+        user = await session.get(User, body["username"])
+
+    # bcrypt runs on a worker thread (or the hashing pool) so the event
+    # loop keeps serving other requests meanwhile
+    if user is None or not await run_in_threadpool(
+            request.app.state.hasher.check_password_hash,
+            user.hashed_password, body["password"]):
+        return error("Invalid username/password", 401)
+
+    return json_response({"token": create_token(
+        request.app.state.jwt_secret_key, user.username, user.is_admin)})
+
+
+async def show_all_users(request):
+    """Returns all users (ADMIN ONLY)"""
+
+    async with request.app.state.sessions() as session:
+        claims = await current_claims(request, session)
+        if claims is None:
+            return error("Missing or invalid token", 401)
+        if claims["is_admin"] != True:
+            return error("This route is admin-protected", 401)
+
+        rows = (await session.execute(
+            select_serialized(User.select_all(), User))).all()
+
+    return json_response({"users": records(rows, User.serialized_columns)})
+
+
+async def get_user_by_username(request):
+    """Returns given user"""
+
+    username = request.path_params["username"]
+
+    async with request.app.state.sessions() as session:
+        if await current_claims(request, session) is None:
+            return error("Missing or invalid token", 401)
+
+        row = (await session.execute(select_serialized(
+            select(User).filter(User.username == username), User))).first()
+
+    if row is None:
+        return error("Not found", 404)
+
+    return json_response(
+        {"user": records([row], User.serialized_columns)[0]})
+
+
+async def get_friends_for_user(request):
+    """Returns page of friends for user ('after' and 'limit' query args)"""
+
+    try:
+        limit = parse_limit(request.query_params.get("limit"))
+        query = User.select_friends(
+            request.path_params["username"],
+            after=request.query_params.get("after"), limit=limit + 1)
+    except PaginationError as e:
+        return error(str(e), 400)
+
+    async with request.app.state.sessions() as session:
+        friends = (await session.execute(select_serialized(query, User))).all()
+
+    next_cursor = User.cursor(friends[limit - 1]) if len(friends) > limit else None
+
+    return json_response({
+        "friends": records(friends[:limit], User.serialized_columns),
+        "next_cursor": next_cursor})
+
+
+async def messages_page(request, username=None):
+    """Return a keyset-paginated page of messages, as app.messages_response"""
+
+    try:
+        limit = parse_limit(request.query_params.get("limit"))
+        query = select_serialized(
+            Message.select_after(
+                username=username, after=request.query_params.get("after"),
+                limit=limit + 1),
+            Message, Message.timestamp)
+    except PaginationError as e:
+        return error(str(e), 400)
+
+    async with request.app.state.sessions() as session:
+        page = (await session.execute(query)).all()
+
+    next_cursor = Message.cursor(page[limit - 1]) if len(page) > limit else None
+
+    return json_response({
+        "messages": records(page[:limit], Message.serialized_columns),
+        "next_cursor": next_cursor})
+
+
+async def get_user_messages(request):
+    """Return page of messages involving user"""
+
+    return await messages_page(request, username=request.path_params["username"])
+
+
+async def get_all_messages(request):
+    """Return page of all messages"""
+
+    return await messages_page(request)
+
+
+async def get_all_friendships(request):
+    """Get all friendship data"""
+
+    async with request.app.state.sessions() as session:
+        rows = (await session.execute(
+            select_serialized(Friendship.select_all(), Friendship))).all()
+
+    return json_response(
+        {"friendships": records(rows, Friendship.serialized_columns)})
+
+
+async def create_stream_token(request):
+    """Returns a short-lived token that only opens the user's event stream,
+    as app.create_stream_token"""
+
+    username = request.path_params["username"]
+
+    async with request.app.state.sessions() as session:
+        claims = await current_claims(request, session)
+    if claims is None:
+        return error("Missing or invalid token", 401)
+    if claims["is_admin"] != True and claims["sub"] != username:
+        return error("Unauthorized", 401)
+
+    return json_response({"token": create_token(
+        request.app.state.jwt_secret_key, claims["sub"], claims["is_admin"],
+        expires=request.app.state.stream_token_expires, stream=True)})
+
+
+async def stream_user_events(request):
+    """Stream the user's new messages and friendship changes (Server-Sent
+    Events), as app.stream_user_events; a stream token may be passed as
+    '?jwt=<token>'"""
+
+    username = request.path_params["username"]
+
+    async with request.app.state.sessions() as session:
+        claims = await current_claims(request, session, stream=True)
+    if claims is None:
+        return error("Missing or invalid token", 401)
+    if claims["is_admin"] != True and claims["sub"] != username:
+        return error("Unauthorized", 401)
+
+    subscription = request.app.state.broker.subscribe([username])
+    keepalive = request.app.state.events_keepalive
+
+    async def generate():
+        try:
+            yield ": connected\n\n"
+            while True:
+                event = await subscription.get_async(timeout=keepalive)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            subscription.close()
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+routes = [
+    Route("/auth/login", login, methods=["POST"]),
+    Route("/users", show_all_users, methods=["GET"]),
+    Route("/users/{username}", get_user_by_username, methods=["GET"]),
+    Route("/users/{username}/friends", get_friends_for_user, methods=["GET"]),
+    Route("/users/{username}/messages", get_user_messages, methods=["GET"]),
+    Route("/users/{username}/events", stream_user_events, methods=["GET"]),
+    Route("/users/{username}/events/token", create_stream_token, methods=["POST"]),
+    Route("/messages", get_all_messages, methods=["GET"]),
+    Route("/friendships", get_all_friendships, methods=["GET"]),
+]
+
+
+def engine_options(url):
+    """Return create_async_engine options for the DB_POOL_* settings, as
+    dbpool.engine_options does for the WSGI app.
+
+    In "pgbouncer" mode each checkout opens a connection (NullPool), and
+    asyncpg's prepared statement caches are off: under transaction pooling
+    consecutive statements may run on different server connections, which
+    don't have each other's prepared statements.
+    """
+
+    if url.startswith("sqlite"):
+        return {}
+
+    mode = os.environ.get("DB_POOL_MODE", "queue")
+    options = {
+        "pool_pre_ping":
+            os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true",
+    }
+
+    if mode == "pgbouncer":
+        options.update(
+            poolclass=NullPool,
+            connect_args={"statement_cache_size": 0,
+                          "prepared_statement_cache_size": 0})
+    elif mode == "queue":
+        options.update(
+            pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+            max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+            pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+            pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)))
+    else:
+        raise ValueError(f"Unknown DB_POOL_MODE: {mode}")
+
+    return options
+
+
+def create_asgi_app(database_url=None):
+    """Create the Starlette app on an async engine for 'database_url'
+    (default: DATABASE_URL). Pooling follows DB_POOL_MODE and the other
+    DB_POOL_* settings, and PUBSUB_URL picks the event broker, as for the
+    WSGI app."""
+
+    url = async_url(database_url or os.environ["DATABASE_URL"])
+    engine = create_async_engine(url, **engine_options(url))
+
+    app = Starlette(routes=routes, on_shutdown=[engine.dispose])
+    app.state.engine = engine
+    app.state.sessions = async_sessionmaker(engine, expire_on_commit=False)
+    # bcrypt runs inline on run_in_threadpool's threads
+    app.state.hasher = PasswordHasher()
+    app.state.hasher.rounds = int(
+        os.environ.get("BCRYPT_LOG_ROUNDS", app.state.hasher.rounds))
+    app.state.user_cache = TTLCache(
+        int(os.environ.get("USER_CACHE_SIZE", 10000)),
+        float(os.environ.get("USER_CACHE_TTL", 30)))
+    app.state.jwt_secret_key = os.environ.get(
+        "JWT_SECRET_KEY", DEFAULT_JWT_SECRET_KEY)
+    app.state.broker = create_broker(
+        os.environ.get("PUBSUB_URL", "memory://"),
+        int(os.environ.get("PUBSUB_QUEUE_SIZE", 100)))
+    app.state.events_keepalive = float(os.environ.get("EVENTS_KEEPALIVE", 15))
+    app.state.stream_token_expires = int(os.environ.get("STREAM_TOKEN_EXPIRES", 60))
+
+    return app
+
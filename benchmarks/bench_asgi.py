@@ -0,0 +1,194 @@
+"""Benchmark WSGI (Flask, threaded) against ASGI (Starlette, async engine).
+
+Seeds a throwaway SQLite file with 'flask generate-data', then serves it in
+turn with each mode in its own process:
+
+- wsgi: app.create_app() on werkzeug's threaded server (a thread per
+  connection)
+- asgi: asgi.create_asgi_app() on uvicorn (one event loop)
+
+and drives a mix of GET /users/<u>, /users/<u>/friends and
+/users/<u>/messages from --concurrency concurrent keep-alive clients per
+step. Reports requests/s, p50/p95/p99 latency, errors and the server
+process's threads and resident memory at the end of each step, as JSON:
+
+    python benchmarks/bench_asgi.py --users 10000 --concurrency 1 16 128 512
+
+Set BENCH_DATABASE_URL to use another database (it is dropped and
+recreated, so never point it at real data).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+SERVERS = {
+    "wsgi": [sys.executable, "-c",
+             "import logging, sys\n"
+             "from werkzeug.serving import run_simple\n"
+             "from app import create_app\n"
+             "logging.getLogger('werkzeug').setLevel(logging.ERROR)\n"
+             "run_simple('127.0.0.1', int(sys.argv[1]), create_app(), threaded=True)"],
+    "asgi": [sys.executable, "-m", "uvicorn", "--factory", "asgi:create_asgi_app",
+             "--host", "127.0.0.1", "--log-level", "warning", "--port"],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} didn't start")
+
+
+def process_status(pid):
+    """Return the server's thread count and resident memory (Linux only)"""
+
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+    except OSError:
+        return {}
+
+    return {
+        "threads": int(fields["Threads"]),
+        "rss_mb": round(int(fields["VmRSS"].split()[0]) / 1024, 1),
+    }
+
+
+async def run_step(base_url, tokens, concurrency, seconds, seed):
+    """Drive 'concurrency' clients for 'seconds'; return a result dict"""
+
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    usernames = list(tokens)
+
+    async def client(http, rng):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            username = rng.choice(usernames)
+            path = rng.choice((
+                f"/users/{username}",
+                f"/users/{username}/friends",
+                f"/users/{username}/messages?limit=20",
+            ))
+            start = time.perf_counter()
+            try:
+                res = await http.get(path, headers={
+                    "Authorization": f"Bearer {tokens[username]}"})
+                ok = res.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            latencies.append((time.perf_counter() - start) * 1000)
+            errors += not ok
+
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(
+            base_url=base_url, limits=limits, timeout=60) as http:
+        await asyncio.gather(*(
+            client(http, random.Random(seed + i)) for i in range(concurrency)))
+    # Requests in flight at the deadline still finish, so this can exceed
+    # 'seconds'
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "requests_per_second": round((len(latencies) - errors) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 2),
+        "errors": errors,
+    }
+
+
+def seed(args, database_url):
+    """Fill the database and return {username: token} for the clients"""
+
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("SECRET_KEY", "bench")
+
+    from app import create_app
+    from asgi import create_token
+    from datagen import generate_data
+
+    app = create_app()
+    with app.app_context():
+        result = app.test_cli_runner().invoke(generate_data, [
+            "--users", str(args.users), "--seed", str(args.seed), "--drop",
+            "--friendships", str(args.users * 5),
+            "--messages", str(args.users * 10),
+        ])
+        if result.exit_code != 0:
+            raise SystemExit(result.output)
+
+    return {f"user{i}": create_token(f"user{i}", False)
+            for i in range(min(args.users, 1000))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[1, 16, 128, 512])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--modes", nargs="+", default=list(SERVERS))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    database_url = os.environ.get("BENCH_DATABASE_URL", f"sqlite:///{tmp.name}")
+    tokens = seed(args, database_url)
+
+    results = {"users": args.users, "seconds": args.seconds, "modes": {}}
+    for mode in args.modes:
+        port = free_port()
+        server = subprocess.Popen(SERVERS[mode] + [str(port)], cwd=ROOT,
+                                  env=dict(os.environ, DATABASE_URL=database_url))
+        try:
+            wait_for(port)
+            steps = []
+            for concurrency in args.concurrency:
+                step = asyncio.run(run_step(
+                    f"http://127.0.0.1:{port}", tokens, concurrency,
+                    args.seconds, args.seed))
+                step.update(process_status(server.pid))
+                steps.append(step)
+            results["modes"][mode] = steps
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(json.dumps(results, indent=2))
+    os.unlink(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Benchmark User.friends for users with many accepted friendships.
+
+Compares the old two-query lookup against the single UNION query, for a hub
+user with 10k+ accepted friendships (both directions) among background noise.
+
+    python benchmarks/bench_friends.py --friends 10000 20000 --repeat 20
+
+Runs against a throwaway SQLite file unless BENCH_DATABASE_URL is set (the target
+database is dropped and recreated, so never point it at real data).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from flask import Flask
+from sqlalchemy import insert, or_
+
+from models import Friendship, User, connect_db, db
+
+HASH = "$2b$12$9ZmCxLgbag8Beioi4FTsXeg89aFBqyWKyvoeqWYRe9LztTsZs/n2u"
+
+
+def legacy_friends(username):
+    """The pre-UNION implementation, kept for comparison"""
+
+    sender_friends = db.session.query(User)\
+        .join(Friendship, User.username == Friendship.sender)\
+        .filter(or_(Friendship.sender == username, Friendship.recipient == username),
+            Friendship.status == 'accepted',
+            Friendship.recipient == username)\
+        .all()
+    recipient_friends = db.session.query(User)\
+        .join(Friendship, User.username == Friendship.recipient)\
+        .filter(or_(Friendship.sender == username, Friendship.recipient == username),
+            Friendship.status == 'accepted',
+            Friendship.sender == username)\
+        .all()
+    return sender_friends + recipient_friends
+
+
+def all_friends(username, page_size):
+    """Walk every page of User.friends"""
+
+    friends = []
+    after = None
+    while True:
+        page = User.friends(username, after=after, limit=page_size)
+        friends.extend(page)
+        if len(page) < page_size:
+            return friends
+        after = User.cursor(page[-1])
+
+
+def seed(num_friends, noise):
+    """Create 'hub' with num_friends accepted friends plus noise edges"""
+
+    db.drop_all()
+    db.create_all()
+
+    num_users = num_friends + noise
+    db.session.execute(insert(User), [
+        dict(username=f"user{i}", email=f"user{i}@example.com",
+             hashed_password=HASH, location=48197, bio="", friend_radius=10,
+             is_admin=False)
+        for i in range(num_users)
+    ] + [dict(username="hub", email="hub@example.com", hashed_password=HASH,
+              location=48197, bio="", friend_radius=10, is_admin=False)])
+
+    # Half the hub's friendships were sent by the hub, half received
+    edges = [
+        dict(sender="hub", recipient=f"user{i}", status="accepted") if i % 2
+        else dict(sender=f"user{i}", recipient="hub", status="accepted")
+        for i in range(num_friends)
+    ]
+    edges += [
+        dict(sender=f"user{i}", recipient=f"user{(i * 7 + 1) % num_users}",
+             status=("accepted", "pending", "rejected")[i % 3])
+        for i in range(noise)
+    ]
+
+    # A pair has at most one friendship (ux_friendships_pair)
+    pairs = set()
+    unique_edges = []
+    for edge in edges:
+        pair = frozenset((edge["sender"], edge["recipient"]))
+        if len(pair) == 2 and pair not in pairs:
+            pairs.add(pair)
+            unique_edges.append(edge)
+
+    db.session.execute(insert(Friendship), unique_edges)
+    db.session.commit()
+
+
+def timed(fn, repeat):
+    """Return latencies in ms for 'repeat' calls of fn"""
+
+    times = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def summarize(times):
+    return {
+        "p50_ms": round(statistics.median(times), 3),
+        "max_ms": round(max(times), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--friends", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--noise", type=int, default=50000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+        "BENCH_DATABASE_URL", f"sqlite:///{tmp.name}")
+    connect_db(app)
+    app.app_context().push()
+
+    results = []
+    for num_friends in args.friends:
+        seed(num_friends, args.noise)
+
+        assert len(legacy_friends("hub")) == num_friends
+        assert len(all_friends("hub", args.page_size)) == num_friends
+
+        results.append({
+            "friends": num_friends,
+            "legacy_all": summarize(timed(
+                lambda: legacy_friends("hub"), args.repeat)),
+            "union_first_page": summarize(timed(
+                lambda: User.friends("hub", limit=args.page_size), args.repeat)),
+            "union_all_pages": summarize(timed(
+                lambda: all_friends("hub", args.page_size), args.repeat)),
+        })
+
+    print(json.dumps(results, indent=2))
+    os.unlink(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
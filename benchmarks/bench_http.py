@@ -0,0 +1,292 @@
+"""End-to-end HTTP benchmark of the main routes at several data scales.
+
+For each --scales entry (a number of users) a fresh process seeds a database
+with 'flask generate-data' (--friends-per-user and --messages-per-user times
+as many friendships and messages), serves the app with a threaded werkzeug
+server and drives every route below from N client threads per
+--concurrency step. Photo uploads use the filesystem backend (no S3).
+
+Prints JSON with, per scale, route and concurrency: requests/s, p50/p95/p99
+latency, database queries per request and status counts, plus the git commit,
+so runs can be saved and compared between commits:
+
+    python benchmarks/bench_http.py --scales 1000 10000 --concurrency 1 8 \\
+        --seconds 5 > bench-$(git rev-parse --short HEAD).json
+
+Runs against a throwaway SQLite file unless BENCH_DATABASE_URL is set (the
+target database is dropped and recreated, so never point it at real data).
+Client threads share the server's process, so absolute numbers understate
+a real deployment; compare runs on the same machine.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+PHOTO = os.path.join(ROOT, "testphoto.jpg")
+
+
+def call(base_url, method, path, token=None, json_body=None, files=None):
+    """Make one request, returning the status code"""
+
+    headers = {}
+    data = None
+    if token is not None:
+        headers["Authorization"] = f"Bearer {token}"
+    if json_body is not None:
+        data = json.dumps(json_body).encode()
+        headers["Content-Type"] = "application/json"
+    if files is not None:
+        boundary = uuid.uuid4().hex
+        data = b"".join(
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"; "
+            f"filename=\"{name}.jpg\"\r\nContent-Type: image/jpeg\r\n\r\n".encode()
+            + content + b"\r\n"
+            for name, content in files.items()) + f"--{boundary}--\r\n".encode()
+        headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+
+    req = urllib.request.Request(
+        base_url + path, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req) as res:
+            res.read()
+            return res.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code
+
+
+def routes(users, tokens, admin_token, photo):
+    """Return {name: fn(rng) -> call() kwargs} for each benchmarked route"""
+
+    def user(rng):
+        return f"user{rng.randrange(len(tokens))}"
+
+    def as_user(rng):
+        username = user(rng)
+        return username, tokens[username]
+
+    def friends(rng):
+        username, token = as_user(rng)
+        return dict(method="GET", path=f"/users/{username}/friends", token=token)
+
+    def user_messages(rng):
+        username, token = as_user(rng)
+        return dict(method="GET", path=f"/users/{username}/messages", token=token)
+
+    def send_message(rng):
+        username, token = as_user(rng)
+        return dict(method="POST", path="/messages", token=token, json_body={
+            "from_user": username, "to_user": user(rng), "text": "Benchmark"})
+
+    def request_friendship(rng):
+        username, token = as_user(rng)
+        other = f"user{rng.randrange(users)}"
+        return dict(method="POST", path="/friendships", token=token, json_body={
+            "sender": username, "recipient": other})
+
+    def upload(rng):
+        username, token = as_user(rng)
+        return dict(method="POST", path=f"/url_route/{username}", token=token,
+                    files={"file_from_react": photo})
+
+    return {
+        "POST /auth/login": lambda rng: dict(
+            method="POST", path="/auth/login",
+            json_body={"username": user(rng), "password": "password"}),
+        "GET /users": lambda rng: dict(
+            method="GET", path="/users", token=admin_token),
+        "GET /users/<u>/friends": friends,
+        "GET /users/<u>/messages": user_messages,
+        "GET /messages": lambda rng: dict(method="GET", path="/messages"),
+        "POST /messages": send_message,
+        "GET /friendships": lambda rng: dict(method="GET", path="/friendships"),
+        "POST /friendships": request_friendship,
+        # Last: resizing continues in the background after the 202
+        "POST /url_route/<u>": upload,
+    }
+
+
+def run_step(base_url, make_request, concurrency, seconds, queries, seed):
+    """Drive 'concurrency' clients for 'seconds'; return a result dict"""
+
+    deadline = time.perf_counter() + seconds
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def client(rng):
+        while time.perf_counter() < deadline:
+            kwargs = make_request(rng)
+            start = time.perf_counter()
+            status = call(base_url, **kwargs)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    queries_before = queries[0]
+    threads = [threading.Thread(target=client, args=(random.Random(seed + i),))
+               for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    ok = sum(count for status, count in statuses.items() if status < 400)
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "requests_per_second": round(ok / seconds, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 2),
+        "queries_per_request": round(
+            (queries[0] - queries_before) / len(latencies), 2),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def run_scale(args):
+    """Seed one scale, benchmark every route and return its result dict"""
+
+    tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    uploads = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = os.environ.get(
+        "BENCH_DATABASE_URL", f"sqlite:///{tmp.name}")
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ["UPLOAD_BACKEND"] = "filesystem"
+    os.environ["UPLOAD_FOLDER"] = uploads
+    # The write routes are measured, not their budgets
+    os.environ["RATELIMIT_ENABLED"] = "false"
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from werkzeug.serving import make_server
+
+    from app import create_app, get_token
+    from datagen import generate_data
+    from models import User, db
+
+    app = create_app()
+    app.app_context().push()
+
+    users = args.run_scale
+    start = time.perf_counter()
+    result = app.test_cli_runner().invoke(generate_data, [
+        "--users", str(users), "--seed", str(args.seed), "--drop",
+        "--friendships", str(users * args.friends_per_user),
+        "--messages", str(users * args.messages_per_user),
+    ])
+    if result.exit_code != 0:
+        raise SystemExit(result.output)
+    seed_seconds = time.perf_counter() - start
+
+    admin = db.session.get(User, "user0")
+    admin.is_admin = True
+    db.session.commit()
+    tokens = {f"user{i}": get_token(db.session.get(User, f"user{i}"))
+              for i in range(min(users, args.clients_users))}
+    admin_token = tokens["user0"]
+    db.session.remove()
+
+    queries = [0]
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def count_query(*args):
+        queries[0] += 1
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    with open(PHOTO, "rb") as f:
+        photo = f.read()
+
+    results = {}
+    for name, make_request in routes(users, tokens, admin_token, photo).items():
+        if args.routes and not any(r in name for r in args.routes):
+            continue
+        results[name] = [
+            run_step(base_url, make_request, c, args.seconds, queries, args.seed)
+            for c in args.concurrency]
+
+    server.shutdown()
+    os.unlink(tmp.name)
+    shutil.rmtree(uploads, ignore_errors=True)
+
+    return {
+        "users": users,
+        "friendships": users * args.friends_per_user,
+        "messages": users * args.messages_per_user,
+        "seed_seconds": round(seed_seconds, 1),
+        "routes": results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--friends-per-user", type=int, default=5)
+    parser.add_argument("--messages-per-user", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--routes", nargs="*",
+                        help="Only routes whose name contains one of these")
+    parser.add_argument("--clients-users", type=int, default=100,
+                        help="How many users the clients act as")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--run-scale", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scale is not None:
+        print(json.dumps(run_scale(args)))
+        return
+
+    # Each scale runs in a fresh process, so caches, the friend graph and
+    # connection pools don't carry over between databases
+    scales = []
+    for users in args.scales:
+        child = subprocess.run(
+            [sys.executable, __file__, "--run-scale", str(users)] + sys.argv[1:],
+            capture_output=True, text=True)
+        if child.returncode != 0:
+            sys.exit(child.stderr)
+        scales.append(json.loads(child.stdout.splitlines()[-1]))
+
+    print(json.dumps({
+        "commit": git_commit(),
+        "bcrypt_rounds": int(os.environ.get("BCRYPT_LOG_ROUNDS", 12)),
+        "seconds": args.seconds,
+        "scales": scales,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
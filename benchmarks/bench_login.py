@@ -0,0 +1,119 @@
+"""Load benchmark for POST /auth/login: the throughput curve by concurrency.
+
+Serves the app with a threaded werkzeug server on a throwaway SQLite file and
+hammers /auth/login from N client threads per step, reporting requests/s,
+latency percentiles and how many requests were shed with 503.
+
+    python benchmarks/bench_login.py --concurrency 1 2 4 8 16 32 --seconds 5
+
+Cost factor and pool size come from the usual BCRYPT_LOG_ROUNDS,
+HASH_POOL_WORKERS and HASH_POOL_MAX_PENDING environment variables.
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+os.environ["DATABASE_URL"] = f"sqlite:///{tmp.name}"
+os.environ.setdefault("SECRET_KEY", "bench")
+
+from werkzeug.serving import make_server
+
+from app import create_app
+from models import User, db
+
+
+def login(url, body):
+    """POST credentials, returning the status code"""
+
+    req = urllib.request.Request(
+        url, data=body, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req) as res:
+            res.read()
+            return res.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def run_step(url, concurrency, seconds):
+    """Drive 'concurrency' clients for 'seconds'; return a result dict"""
+
+    body = json.dumps({"username": "bench", "password": "password"}).encode()
+    deadline = time.perf_counter() + seconds
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def client():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            status = login(url, body)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests_per_second": round(statuses.get(200, 0) / seconds, 1),
+        "p50_ms": round(statistics.median(latencies), 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 1),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 1),
+        "statuses": statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.app_context().push()
+
+    db.create_all()
+    User.register(username="bench", email="bench@example.com",
+                  password="password", location=48197, bio="",
+                  friend_radius=10, photo=None, is_admin=False)
+    db.session.commit()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/auth/login"
+
+    results = {
+        "rounds": app.config["BCRYPT_LOG_ROUNDS"],
+        "workers": app.config["HASH_POOL_WORKERS"],
+        "max_pending": app.config["HASH_POOL_MAX_PENDING"],
+        "steps": [run_step(url, c, args.seconds) for c in args.concurrency],
+    }
+
+    server.shutdown()
+    print(json.dumps(results, indent=2))
+    os.unlink(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
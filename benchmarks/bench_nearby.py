@@ -0,0 +1,152 @@
+"""Benchmark GET /users/<username>/nearby lookups over synthetic users.
+
+Seeds --users users (default one million) at random zips from
+data/zip_coordinates.csv, then times, for several radii:
+
+- the grid lookup (ZipIndex.within) against a brute-force scan of every zip
+- a page of User.nearby, which seeks the users.location index per zip
+
+    python benchmarks/bench_nearby.py --users 1000000 --radius 10 25 50
+
+Runs against a throwaway SQLite file unless BENCH_DATABASE_URL is set (the target
+database is dropped and recreated, so never point it at real data).
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from flask import Flask
+from sqlalchemy import insert
+
+from geo import DEFAULT_ZIP_FILE, ZipIndex, haversine
+from models import Friendship, User, connect_db, db
+
+HASH = "$2b$12$9ZmCxLgbag8Beioi4FTsXeg89aFBqyWKyvoeqWYRe9LztTsZs/n2u"
+BATCH_SIZE = 50000
+
+
+def brute_force_within(zip_index, zip, radius):
+    """Distance-check every zip; what ZipIndex.within avoids"""
+
+    lat, lng = zip_index.coordinates[zip]
+    return {
+        other: d for other, (olat, olng) in zip_index.coordinates.items()
+        if (d := haversine(lat, lng, olat, olng)) <= radius
+    }
+
+
+def seed(num_users, zips, rng):
+    """Insert num_users at random zips, plus a few friendships each"""
+
+    db.drop_all()
+    db.create_all()
+
+    for start in range(0, num_users, BATCH_SIZE):
+        db.session.execute(insert(User), [
+            dict(username=f"user{i}", email=f"user{i}@example.com",
+                 hashed_password=HASH, location=rng.choice(zips), bio="",
+                 friend_radius=25, is_admin=False)
+            for i in range(start, min(start + BATCH_SIZE, num_users))
+        ])
+
+    # A pair has at most one friendship (ux_friendships_pair)
+    pairs = set()
+    for start in range(0, num_users, BATCH_SIZE):
+        edges = []
+        for i in range(start, min(start + BATCH_SIZE, num_users)):
+            j = rng.randrange(num_users)
+            pair = (min(i, j), max(i, j))
+            if i != j and pair not in pairs:
+                pairs.add(pair)
+                edges.append(dict(
+                    sender=f"user{i}", recipient=f"user{j}",
+                    status=rng.choice(("accepted", "pending", "rejected"))))
+        db.session.execute(insert(Friendship), edges)
+
+    db.session.commit()
+
+
+def timed(fn, repeat):
+    """Return (last result, latencies in ms) for 'repeat' calls of fn"""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return result, times
+
+
+def summarize(times):
+    return {
+        "p50_ms": round(statistics.median(times), 3),
+        "p95_ms": round(sorted(times)[int(len(times) * 0.95) - 1], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--radius", type=int, nargs="+", default=[10, 25, 50])
+    parser.add_argument("--callers", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    zip_index = ZipIndex.from_csv(DEFAULT_ZIP_FILE)
+    zips = sorted(zip_index.coordinates)
+
+    tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+        "BENCH_DATABASE_URL", f"sqlite:///{tmp.name}")
+    connect_db(app)
+    app.app_context().push()
+
+    start = time.perf_counter()
+    seed(args.users, zips, rng)
+    seed_seconds = time.perf_counter() - start
+
+    callers = [db.session.get(User, f"user{rng.randrange(args.users)}")
+               for _ in range(args.callers)]
+
+    results = {"users": args.users, "seed_seconds": round(seed_seconds, 1),
+               "radii": []}
+    for radius in args.radius:
+        grid, brute, query, found = [], [], [], []
+        for caller in callers:
+            distances, times = timed(
+                lambda: zip_index.within(caller.location, radius), 1)
+            grid += times
+            brute += timed(
+                lambda: brute_force_within(zip_index, caller.location, radius), 1)[1]
+
+            page, times = timed(lambda: User.nearby(
+                caller.username, distances, limit=args.page_size), 1)
+            query += times
+            found.append(len(page))
+            db.session.expunge_all()
+
+        results["radii"].append({
+            "radius_miles": radius,
+            "grid_lookup": summarize(grid),
+            "brute_force_lookup": summarize(brute),
+            "nearby_page_query": summarize(query),
+            "mean_page_rows": round(statistics.mean(found), 1),
+        })
+
+    print(json.dumps(results, indent=2))
+    os.unlink(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Benchmark the rate limiter's hot path.
+
+Times RateLimiter.hit (key lookup, refill and take) for each store, from
+one thread and from several at once, over a working set of --keys client
+keys, and the whole per-request cost of @rate_limit on a Flask view
+(JWT verification included) against the same view undecorated. Prints
+microseconds per call as JSON:
+
+    python benchmarks/bench_ratelimit.py --calls 200000 --threads 1 8
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from flask import Flask
+from flask_jwt_extended import JWTManager, create_access_token
+
+from ratelimit import RateLimited, RateLimiter, rate_limit
+
+# High enough that no call is refused: the allowed path is the common one
+BUDGET = "1000000/second"
+
+
+def make_limiter(url):
+    app = Flask(__name__)
+    app.config.update(RATELIMIT_STORAGE_URL=url, RATELIMITS={"bench": BUDGET})
+    return RateLimiter(app)
+
+
+def time_hits(limiter, keys, calls, threads):
+    """Return µs per hit with 'threads' threads sharing 'calls' hits"""
+
+    per_thread = calls // threads
+    barrier = threading.Barrier(threads + 1)
+
+    def work(offset):
+        barrier.wait()
+        for i in range(per_thread):
+            try:
+                limiter.hit("bench", keys[(offset + i) % len(keys)])
+            except RateLimited:
+                pass
+
+    workers = [threading.Thread(target=work, args=(n * 7919,))
+               for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+
+    return (time.perf_counter() - start) / (per_thread * threads) * 1e6
+
+
+def time_requests(calls):
+    """Return µs per request for an undecorated and a limited view"""
+
+    app = Flask(__name__)
+    app.config.update(JWT_SECRET_KEY="bench-" * 8, RATELIMITS={"bench": BUDGET})
+    JWTManager(app)
+    RateLimiter(app)
+
+    @app.route("/plain", methods=["POST"])
+    def plain():
+        return ""
+
+    @app.route("/limited", methods=["POST"])
+    @rate_limit("bench")
+    def limited():
+        return ""
+
+    with app.app_context():
+        headers = {"Authorization": f"Bearer {create_access_token('bench')}"}
+
+    client = app.test_client()
+    results = {}
+    for path in ("/plain", "/limited"):
+        start = time.perf_counter()
+        for _ in range(calls):
+            client.post(path, headers=headers)
+        results[path.strip("/")] = (time.perf_counter() - start) / calls * 1e6
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    keys = [f"user:user{i}" for i in range(args.keys)]
+    path = os.path.join(tempfile.mkdtemp(), "ratelimit")
+    stores = {"memory": "memory://", "mmap": f"mmap://{path}"}
+
+    results = {"calls": args.calls, "keys": args.keys, "hit_us": {}}
+    for name, url in stores.items():
+        limiter = make_limiter(url)
+        results["hit_us"][name] = {
+            f"{threads}_threads": round(
+                time_hits(limiter, keys, args.calls, threads), 3)
+            for threads in args.threads
+        }
+
+    request_us = time_requests(args.requests)
+    results["request_us"] = {k: round(v, 1) for k, v in request_us.items()}
+    results["request_overhead_us"] = round(
+        request_us["limited"] - request_us["plain"], 1)
+
+    print(json.dumps(results, indent=2))
+    os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
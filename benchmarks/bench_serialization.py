@@ -0,0 +1,150 @@
+"""Benchmark list serialization: ORM objects + serialize() vs column rows.
+
+Seeds --rows users, messages and friendships, then times encoding each whole
+table the way list routes used to (load ORM objects, call serialize() per row,
+encode with Flask's JSON provider as jsonify does) against the projection path
+(select_serialized rows, serialization.records, serialization.dumps), plus
+MessagePack when msgpack is installed.
+
+    python benchmarks/bench_serialization.py --rows 100000
+
+Runs against a throwaway SQLite file unless BENCH_DATABASE_URL is set (the target
+database is dropped and recreated, so never point it at real data).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from flask import Flask
+from sqlalchemy import insert
+
+import serialization
+from models import (
+    Friendship, Message, User, connect_db, db, select_serialized
+)
+
+HASH = "$2b$12$9ZmCxLgbag8Beioi4FTsXeg89aFBqyWKyvoeqWYRe9LztTsZs/n2u"
+BATCH_SIZE = 50000
+
+
+def seed(rows):
+    """Insert 'rows' each of users, messages and friendships"""
+
+    db.drop_all()
+    db.create_all()
+    start = datetime(2023, 1, 1)
+
+    for first in range(0, rows, BATCH_SIZE):
+        batch = range(first, min(first + BATCH_SIZE, rows))
+
+        db.session.execute(insert(User), [
+            dict(username=f"user{i}", email=f"user{i}@example.com",
+                 hashed_password=HASH, location=48197, bio="Hello there",
+                 friend_radius=25, is_admin=False)
+            for i in batch
+        ])
+        db.session.execute(insert(Message), [
+            dict(from_user=f"user{i}", to_user=f"user{(i + 1) % rows}",
+                 user_a=min(f"user{i}", f"user{(i + 1) % rows}"),
+                 user_b=max(f"user{i}", f"user{(i + 1) % rows}"),
+                 text=f"Message number {i}", timestamp=start + timedelta(seconds=i))
+            for i in batch
+        ])
+        db.session.execute(insert(Friendship), [
+            dict(sender=f"user{i}", recipient=f"user{(i + 7) % rows}",
+                 status="accepted")
+            for i in batch
+        ])
+
+    db.session.commit()
+
+
+# Table -> (model, builder of a select over the whole table)
+TABLES = {
+    "users": (User, User.select_all),
+    "messages": (Message, Message.select_after),
+    "friendships": (Friendship, Friendship.select_all),
+}
+
+
+def orm_path(app, model, select_all):
+    """Previous path: ORM objects, serialize() each, encode as jsonify does"""
+
+    items = db.session.scalars(select_all()).all()
+    body = app.json.dumps([item.serialize() for item in items])
+    db.session.expunge_all()
+    return body
+
+
+def rows_path(model, select_all, encode):
+    """Projection path: plain rows of the serialized columns"""
+
+    rows = db.session.execute(select_serialized(select_all(), model)).all()
+    return encode(serialization.records(rows, model.serialized_columns))
+
+
+def timed(fn, repeat):
+    """Return (size of fn()'s output, latencies in ms) over 'repeat' calls"""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return len(body), times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+        "BENCH_DATABASE_URL", f"sqlite:///{tmp.name}")
+    connect_db(app)
+    app.app_context().push()
+
+    seed(args.rows)
+
+    paths = {"rows_json": serialization.dumps}
+    if serialization.msgpack is not None:
+        paths["rows_msgpack"] = serialization.msgpack.packb
+
+    results = {
+        "rows": args.rows,
+        "json_encoder": "orjson" if serialization.orjson else "json",
+        "tables": {},
+    }
+    for table_name, (model, select_all) in TABLES.items():
+        size, times = timed(lambda: orm_path(app, model, select_all), args.repeat)
+        table = {"orm_serialize_jsonify": {
+            "median_ms": round(statistics.median(times), 1), "bytes": size}}
+
+        for name, encode in paths.items():
+            size, times = timed(
+                lambda: rows_path(model, select_all, encode), args.repeat)
+            table[name] = {
+                "median_ms": round(statistics.median(times), 1), "bytes": size}
+
+        table["speedup"] = round(
+            table["orm_serialize_jsonify"]["median_ms"]
+            / table["rows_json"]["median_ms"], 1)
+        results["tables"][table_name] = table
+
+    print(json.dumps(results, indent=2))
+    os.unlink(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Benchmark cold start: interpreter launch to first served request.
+
+Each run is a fresh Python process that imports app, calls create_app() and
+serves one request through the test client, so import, app construction and
+first-request costs are all measured as a worker or test run would pay them.
+Prints medians over --runs as JSON, to be tracked across releases.
+
+    python benchmarks/bench_startup.py --runs 10
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+created = time.perf_counter()
+with flask_app.app_context():
+    app.db.create_all()
+response = flask_app.test_client().get("/users/nobody/friends")
+assert response.status_code == 200, response.status_code
+served = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "first_request_ms": (served - created) * 1000,
+    "heavy_modules_loaded": sorted(
+        m for m in ("boto3", "botocore", "PIL", "redis", "faker") if m in __import__("sys").modules),
+}))
+"""
+
+
+def run_once():
+    """Start a fresh interpreter; return its timings plus total wall time"""
+
+    env = dict(os.environ, SECRET_KEY=os.environ.get("SECRET_KEY", "bench"))
+
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD], cwd=ROOT, env=env,
+        capture_output=True, text=True, check=True).stdout
+    total = (time.perf_counter() - start) * 1000
+
+    timings = json.loads(out.strip().splitlines()[-1])
+    timings["process_total_ms"] = total
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+
+    result = {
+        key: round(statistics.median(r[key] for r in runs), 1)
+        for key in ("import_ms", "create_app_ms", "first_request_ms",
+                    "process_total_ms")
+    }
+    result["runs"] = args.runs
+    result["heavy_modules_loaded"] = runs[-1]["heavy_modules_loaded"]
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Load test for GET /users/<username>/events with many idle subscribers.
+
+Opens --subscribers event streams (default 10k) through the app in-process
+and leaves them idle, then reports:
+
+- memory per idle subscription on the broker alone
+- memory per open SSE response (broker subscription + generator + request
+  objects), measured with tracemalloc and as process RSS growth (the RSS
+  figure includes tracemalloc's own bookkeeping, so it's an upper bound)
+- how long publishing one event to a subscribed user takes with every
+  stream still open
+
+Sockets and server threads aren't included: their cost depends on the
+server (gunicorn.conf.py's gthread workers pay a thread stack per stream;
+raise GUNICORN_THREADS for thousands of streams).
+
+    python benchmarks/bench_subscribers.py --subscribers 10000
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+os.environ["DATABASE_URL"] = f"sqlite:///{tmp.name}"
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("EVENTS_KEEPALIVE", "3600")
+
+from flask_jwt_extended import create_access_token
+
+from app import create_app
+from models import User, db, pubsub
+from pubsub import MemoryBroker
+
+
+def rss_kb():
+    """Peak resident set size of this process in KB (Linux units)"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(fn):
+    """Run fn(), returning (result, bytes allocated and still held)"""
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = fn()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    held = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return result, held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=10000)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.app_context().push()
+    n = args.subscribers
+
+    db.create_all()
+    db.session.add(User(username="admin", email="admin@example.com",
+                        hashed_password="x", location=48197, bio="",
+                        friend_radius=10, is_admin=True))
+    db.session.commit()
+    token = create_access_token(identity="admin",
+                                additional_claims={"is_admin": True, "stream": True})
+
+    broker = MemoryBroker()
+    subscriptions, broker_bytes = measure(
+        lambda: [broker.subscribe([f"user{i}"]) for i in range(n)])
+    for s in subscriptions:
+        s.close()
+
+    client = app.test_client()
+
+    def open_streams():
+        streams = []
+        for i in range(n):
+            response = client.get(f"/users/user{i}/events?jwt={token}",
+                                  buffered=False)
+            next(response.response)
+            streams.append(response)
+        return streams
+
+    rss_before = rss_kb()
+    start = time.perf_counter()
+    streams, stream_bytes = measure(open_streams)
+    open_seconds = time.perf_counter() - start
+    rss_after = rss_kb()
+
+    start = time.perf_counter()
+    pubsub.publish(f"user{n // 2}", {"type": "message", "data": {"id": 1}})
+    delivered = next(streams[n // 2].response)
+    publish_ms = (time.perf_counter() - start) * 1000
+    assert delivered.startswith(b"event: message")
+
+    subscribed = pubsub.broker.stats()["subscriptions"]
+    for response in streams:
+        response.close()
+
+    print(json.dumps({
+        "subscribers": n,
+        "broker_bytes_per_subscription": round(broker_bytes / n),
+        "sse_bytes_per_stream": round(stream_bytes / n),
+        "sse_rss_kb_per_stream": round((rss_after - rss_before) / n, 2),
+        "open_seconds": round(open_seconds, 2),
+        "publish_to_one_ms": round(publish_ms, 3),
+        "subscriptions_while_open": subscribed,
+        "subscriptions_after_close": pubsub.broker.stats()["subscriptions"],
+    }, indent=2))
+    os.unlink(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Benchmark the friend-of-friend suggestions engine on a synthetic graph.
+
+Builds a FriendGraph from --edges accepted friendships among --users users,
+wired by preferential attachment so degrees follow a power law like a real
+social graph (a few hubs, a long tail), then reports:
+
+- build time and approximate memory held by the graph
+- FriendGraph.suggestions latency for random users and for the biggest hubs
+- incremental add_edge latency
+
+    python benchmarks/bench_suggestions.py --users 1000000 --edges 5000000
+
+The graph is built in memory only; no database is involved.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from graph import FriendGraph
+
+
+def power_law_pairs(num_users, num_edges, rng, attachment=0.8):
+    """Yield num_edges (username, username) friendships.
+
+    Each end of a new edge is, with probability 'attachment', a random
+    endpoint of an earlier edge, so well-connected users keep gaining friends.
+    """
+
+    def pick():
+        if endpoints and rng.random() < attachment:
+            return rng.choice(endpoints)
+        return rng.randrange(num_users)
+
+    endpoints = []
+    for _ in range(num_edges):
+        a, b = pick(), pick()
+        if a != b:
+            endpoints += (a, b)
+            yield f"user{a}", f"user{b}"
+
+
+def graph_size(graph):
+    """Approximate bytes held by the graph's ids, names and arrays"""
+
+    return (sys.getsizeof(graph.ids) + sys.getsizeof(graph.names)
+            + sys.getsizeof(graph.adjacency)
+            + sum(sys.getsizeof(name) for name in graph.names)
+            + sum(sys.getsizeof(friends) for friends in graph.adjacency))
+
+
+def percentiles(times):
+    times = sorted(times)
+    return {
+        "p50_ms": round(statistics.median(times), 3),
+        "p95_ms": round(times[int(len(times) * 0.95) - 1], 3),
+        "p99_ms": round(times[int(len(times) * 0.99) - 1], 3),
+    }
+
+
+def timed(fn, args_list):
+    times = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--edges", type=int, default=5_000_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pairs = list(power_law_pairs(args.users, args.edges, rng))
+
+    graph = FriendGraph(load=lambda: pairs)
+    start = time.perf_counter()
+    graph.build(pairs)
+    build_seconds = time.perf_counter() - start
+
+    names = graph.names
+    degrees = sorted(range(len(names)), key=lambda i: len(graph.adjacency[i]))
+    hubs = [names[i] for i in degrees[-10:]]
+    random_users = [rng.choice(names) for _ in range(args.queries)]
+
+    random_times = timed(graph.suggestions,
+                         [(u, args.limit) for u in random_users])
+    hub_times = timed(graph.suggestions, [(u, args.limit) for u in hubs])
+    add_times = timed(graph.add_edge, [
+        (rng.choice(names), rng.choice(names)) for _ in range(args.queries)])
+
+    print(json.dumps({
+        "users": len(names),
+        "friendships": graph.stats()["friendships"],
+        "max_degree": len(graph.adjacency[degrees[-1]]),
+        "median_degree": len(graph.adjacency[degrees[len(degrees) // 2]]),
+        "build_seconds": round(build_seconds, 1),
+        "graph_mb": round(graph_size(graph) / 2**20, 1),
+        "suggestions_random_users": percentiles(random_times),
+        "suggestions_top_hubs": percentiles(hub_times),
+        "add_edge": percentiles(add_times),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
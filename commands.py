@@ -0,0 +1,232 @@
+"""Flask CLI commands for maintaining the Friender database"""
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import case, delete, func, inspect, select, text, tuple_, update
+
+from models import Conversation, Friendship, Message, User, db
+from search import message_search, user_search
+
+
+def add_missing_columns(table, columns):
+    """ALTER TABLE to add any of 'columns' (name -> SQL type) not yet present.
+
+    Returns the names that were added.
+    """
+
+    existing = {c["name"] for c in inspect(db.engine).get_columns(table)}
+    added = [name for name in columns if name not in existing]
+
+    for name in added:
+        db.session.execute(
+            text(f"ALTER TABLE {table} ADD COLUMN {name} {columns[name]}"))
+
+    return added
+
+
+def backfill_in_batches(model, stmt, batch_size):
+    """Run an UPDATE over model's rows one id range at a time"""
+
+    max_id = db.session.scalar(db.select(db.func.max(model.id))) or 0
+
+    for start in range(0, max_id + 1, batch_size):
+        db.session.execute(
+            stmt.filter(model.id >= start, model.id < start + batch_size))
+        db.session.commit()
+        click.echo(f"  ...{min(start + batch_size, max_id + 1)}/{max_id + 1}")
+
+
+def ensure_row_versions(batch_size):
+    """Add and backfill updated_at on users, messages and friendships.
+
+    Runs before any other backfill: the models bump updated_at on every
+    UPDATE, which fails while the column is missing.
+    """
+
+    if add_missing_columns("users", {"updated_at": "TIMESTAMP"}):
+        click.echo("Backfilling users.updated_at")
+        db.session.execute(update(User).values(updated_at=db.func.now()))
+        db.session.commit()
+
+    if add_missing_columns("messages", {"updated_at": "TIMESTAMP"}):
+        click.echo("Backfilling messages.updated_at")
+        backfill_in_batches(Message, update(Message).values(
+            updated_at=Message.timestamp), batch_size)
+
+    if add_missing_columns("friendships", {"updated_at": "TIMESTAMP"}):
+        click.echo("Backfilling friendships.updated_at")
+        backfill_in_batches(Friendship, update(Friendship).values(
+            updated_at=db.func.now()), batch_size)
+
+    if db.engine.dialect.name == "postgresql":
+        for table in ("users", "messages", "friendships"):
+            db.session.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN updated_at SET NOT NULL"))
+        db.session.commit()
+
+
+def ensure_read_receipts(batch_size):
+    """Add messages.read_at and the conversations' unread counters.
+
+    Messages sent before read receipts existed are marked read as of when
+    they were sent, so nobody's inbox lights up with their whole history.
+    """
+
+    add_missing_columns("conversations", {
+        "unread_a": "INTEGER NOT NULL DEFAULT 0",
+        "unread_b": "INTEGER NOT NULL DEFAULT 0",
+    })
+
+    if add_missing_columns("messages", {"read_at": "TIMESTAMP"}):
+        click.echo("Backfilling messages.read_at")
+        # updated_at kept as is, or the onupdate would mark every message
+        # changed and invalidate every ETag
+        backfill_in_batches(Message, update(Message).values(
+            read_at=Message.timestamp, updated_at=Message.updated_at), batch_size)
+
+
+@click.command("rebuild-conversations")
+@click.option("--batch-size", default=10000, show_default=True)
+@with_appcontext
+def rebuild_conversations(batch_size):
+    """Backfill message pair columns and rebuild the conversations table."""
+
+    db.create_all()
+    ensure_row_versions(batch_size)
+    ensure_read_receipts(batch_size)
+
+    added = add_missing_columns("messages", {"user_a": "TEXT", "user_b": "TEXT"})
+    if added:
+        click.echo("Backfilling messages.user_a / user_b")
+        backfill_in_batches(Message, update(Message).values(
+            user_a=case((Message.from_user < Message.to_user, Message.from_user),
+                        else_=Message.to_user),
+            user_b=case((Message.from_user < Message.to_user, Message.to_user),
+                        else_=Message.from_user),
+            updated_at=Message.updated_at,
+        ), batch_size)
+
+        if db.engine.dialect.name == "postgresql":
+            db.session.execute(text(
+                "ALTER TABLE messages ALTER COLUMN user_a SET NOT NULL, "
+                "ALTER COLUMN user_b SET NOT NULL"))
+            db.session.commit()
+
+        for index in Message.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    click.echo("Rebuilding conversations")
+    Conversation.rebuild()
+    db.session.commit()
+    click.echo("Done")
+
+
+@click.command("add-row-versions")
+@click.option("--batch-size", default=10000, show_default=True)
+@with_appcontext
+def add_row_versions(batch_size):
+    """Add and backfill updated_at on users, messages and friendships."""
+
+    db.create_all()
+    ensure_row_versions(batch_size)
+    click.echo("Done")
+
+
+@click.command("add-read-receipts")
+@click.option("--batch-size", default=10000, show_default=True)
+@with_appcontext
+def add_read_receipts(batch_size):
+    """Add messages.read_at and conversation unread counts."""
+
+    db.create_all()
+    ensure_row_versions(batch_size)
+    ensure_read_receipts(batch_size)
+    db.session.commit()
+    click.echo("Done")
+
+
+@click.command("add-upload-jobs")
+@with_appcontext
+def add_upload_jobs():
+    """Add the upload_jobs table photo upload statuses are kept in."""
+
+    db.create_all()
+    click.echo("Done")
+
+
+# Which row of a duplicated pair survives compaction: the most settled
+# status, then the oldest request
+STATUS_PRIORITY = {"accepted": 0, "rejected": 1, "pending": 2}
+
+
+@click.command("compact-friendships")
+@click.option("--batch-size", default=1000, show_default=True)
+@with_appcontext
+def compact_friendships(batch_size):
+    """Fill friendship pair columns, drop duplicate pairs, add unique index."""
+
+    db.create_all()
+    ensure_row_versions(batch_size)
+
+    if add_missing_columns("friendships", {"user_a": "TEXT", "user_b": "TEXT"}):
+        click.echo("Backfilling friendships.user_a / user_b")
+        backfill_in_batches(Friendship, update(Friendship).values(
+            user_a=case((Friendship.sender < Friendship.recipient, Friendship.sender),
+                        else_=Friendship.recipient),
+            user_b=case((Friendship.sender < Friendship.recipient, Friendship.recipient),
+                        else_=Friendship.sender),
+            updated_at=Friendship.updated_at,
+        ), batch_size)
+
+    pairs = db.session.execute(
+        select(Friendship.user_a, Friendship.user_b)
+        .group_by(Friendship.user_a, Friendship.user_b)
+        .having(func.count() > 1)).all()
+    click.echo(f"Compacting {len(pairs)} duplicated pairs")
+
+    for start in range(0, len(pairs), batch_size):
+        batch = [tuple(pair) for pair in pairs[start:start + batch_size]]
+        rows = db.session.execute(
+            select(Friendship.id, Friendship.user_a, Friendship.user_b,
+                   Friendship.status)
+            .filter(tuple_(Friendship.user_a, Friendship.user_b).in_(batch))).all()
+
+        keep = {}
+        for row in sorted(rows, key=lambda r: (
+                STATUS_PRIORITY.get(r.status, len(STATUS_PRIORITY)), r.id)):
+            keep.setdefault((row.user_a, row.user_b), row.id)
+
+        db.session.execute(delete(Friendship).filter(
+            Friendship.id.in_([r.id for r in rows if r.id not in keep.values()])))
+        db.session.commit()
+        click.echo(f"  ...{min(start + batch_size, len(pairs))}/{len(pairs)}")
+
+    # Self-requests can't be made anymore; drop any left from before
+    db.session.execute(
+        delete(Friendship).filter(Friendship.sender == Friendship.recipient))
+
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(text(
+            "ALTER TABLE friendships ALTER COLUMN user_a SET NOT NULL, "
+            "ALTER COLUMN user_b SET NOT NULL"))
+    db.session.commit()
+
+    for index in Friendship.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+    click.echo("Done")
+
+
+@click.command("create-search-index")
+@with_appcontext
+def create_search_index():
+    """Add full-text search indexes and triggers to existing tables."""
+
+    db.create_all()
+
+    for index in (user_search, message_search):
+        click.echo(f"Indexing {index.table}.{index.field}")
+        index.create()
+        db.session.commit()
+
+    click.echo("Done")
@@ -0,0 +1,65 @@
+"""Conditional GET: ETag / Last-Modified validators and 304 responses.
+
+Routes work out a validator first (a row's updated_at, or a page summary
+from models.select_version) and only query and serialize the body when the
+client's copy is out of date.
+"""
+
+import hashlib
+from datetime import timezone
+
+from flask import Response, make_response, request
+
+from serialization import negotiate
+
+
+def make_etag(*parts):
+    """Return a strong ETag for a representation identified by 'parts'.
+
+    The negotiated mimetype is included, since JSON and MessagePack bodies
+    of the same rows differ.
+    """
+
+    return hashlib.sha1(repr((negotiate(),) + parts).encode()).hexdigest()
+
+
+def is_not_modified(etag, last_modified=None):
+    """Return whether the client's cached copy is current.
+
+    If-None-Match wins over If-Modified-Since when both are sent.
+    """
+
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if request.if_modified_since and last_modified is not None:
+        return _http_date(last_modified) <= request.if_modified_since
+
+    return False
+
+
+def conditional(build, etag, last_modified=None):
+    """Return 304 if the client's copy is current, else build()'s response.
+
+    Either way the response carries the validators, and must be revalidated
+    before reuse.
+    """
+
+    if is_not_modified(etag, last_modified):
+        response = Response(status=304)
+    else:
+        response = make_response(build())
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = _http_date(last_modified)
+    response.cache_control.no_cache = True
+    response.vary.add("Accept")
+
+    return response
+
+
+def _http_date(value):
+    """Naive UTC datetime -> aware, truncated to HTTP date precision"""
+
+    return value.replace(tzinfo=timezone.utc, microsecond=0)
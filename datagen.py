@@ -0,0 +1,208 @@
+"""Synthetic data for load testing: 'flask generate-data'.
+
+Generates users, a power-law friendship graph and messages between friends,
+all from one seed, so two runs with the same options produce the same rows.
+Rows are streamed in batches (COPY on PostgreSQL, executemany elsewhere) and
+nothing is held in memory but the graph's edges, at 8 bytes each.
+
+Usernames are <prefix><n> and every user's password is --password, so load
+tests can log in as any of them. Tables are only dropped with --drop.
+"""
+
+import csv
+import io
+import random
+from array import array
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import insert
+
+from geo import get_zip_index
+from models import Conversation, Friendship, Message, User, db, hasher
+
+# Share of generated friendships in each status
+STATUS_WEIGHTS = {"accepted": 0.8, "pending": 0.15, "rejected": 0.05}
+
+# Bios and message texts are drawn from this many Faker sentences; calling
+# Faker per row would dominate the run time
+SENTENCE_POOL = 10000
+
+# Share of generated messages already read by their recipient
+READ_SHARE = 0.9
+
+# Messages are timestamped over the year from here (fixed, not relative to
+# now, so the same seed gives the same rows)
+MESSAGES_SINCE = datetime(2023, 1, 1)
+
+
+def power_law_edges(num_users, num_edges, rng, attachment=0.8):
+    """Return a flat array of (user, user) index pairs, with no repeats.
+
+    Users join in order and each links to about num_edges / num_users
+    earlier users, picked with probability 'attachment' in proportion to
+    their current friend count (preferential attachment), so a few hubs end
+    up with many friends and most users with a few.
+    """
+
+    per_user = num_edges / max(num_users - 1, 1)
+    edges = array("i")
+
+    for user in range(1, num_users):
+        wanted = min(int(per_user) + (rng.random() < per_user % 1), user)
+        friends = set()
+        while len(friends) < wanted:
+            if edges and rng.random() < attachment:
+                friends.add(edges[rng.randrange(len(edges))])
+            else:
+                friends.add(rng.randrange(user))
+        for friend in sorted(friends):
+            edges.extend((user, friend))
+
+    return edges
+
+
+def copy_rows(model, columns, rows):
+    """COPY rows (tuples in 'columns' order) into model's table"""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {model.__tablename__} ({', '.join(columns)}) "
+        f"FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def insert_rows(model, columns, rows):
+    """Insert rows (tuples in 'columns' order) into model's table"""
+
+    if db.engine.dialect.name == "postgresql":
+        copy_rows(model, columns, rows)
+    else:
+        db.session.execute(
+            insert(model), [dict(zip(columns, row)) for row in rows])
+
+
+def load_in_batches(label, model, columns, rows, total, batch_size):
+    """Insert the 'total' rows yielded by 'rows', committing each batch"""
+
+    batch = []
+    done = 0
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            insert_rows(model, columns, batch)
+            db.session.commit()
+            done += len(batch)
+            batch = []
+            click.echo(f"  {label}: {done}/{total}")
+
+    if batch:
+        insert_rows(model, columns, batch)
+        db.session.commit()
+        click.echo(f"  {label}: {done + len(batch)}/{total}")
+
+
+@click.command("generate-data")
+@click.option("--users", default=10000, show_default=True)
+@click.option("--friendships", default=50000, show_default=True)
+@click.option("--messages", default=100000, show_default=True)
+@click.option("--seed", default=0, show_default=True,
+              help="Same seed and options, same data.")
+@click.option("--prefix", default="user", show_default=True,
+              help="Usernames are <prefix><n>.")
+@click.option("--password", default="password", show_default=True,
+              help="Password of every generated user.")
+@click.option("--batch-size", default=10000, show_default=True)
+@click.option("--drop", is_flag=True,
+              help="Drop and recreate all tables first.")
+@with_appcontext
+def generate_data(users, friendships, messages, seed, prefix, password,
+                  batch_size, drop):
+    """Generate users, a power-law friendship graph and messages."""
+
+    if drop:
+        click.echo("Dropping all tables")
+        db.drop_all()
+    db.create_all()
+
+    if db.session.get(User, f"{prefix}0") is not None:
+        raise click.UsageError(
+            f"Users named {prefix}<n> already exist; "
+            f"pass --drop or a different --prefix")
+
+    # Imported here so web workers, which load this module for the CLI
+    # command, don't pay for Faker at startup
+    from faker import Faker
+
+    rng = random.Random(seed)
+    fake = Faker()
+    fake.seed_instance(seed)
+    sentences = [fake.sentence() for _ in range(SENTENCE_POOL)]
+    zips = sorted(get_zip_index(
+        current_app.config["ZIP_COORDINATES_FILE"]).coordinates)
+    hashed_password = hasher.generate_password_hash(password)
+    now = datetime.utcnow()
+
+    def username(i):
+        return f"{prefix}{i}"
+
+    load_in_batches("users", User, (
+        "username", "email", "hashed_password", "location", "bio",
+        "friend_radius", "is_admin", "updated_at",
+    ), (
+        (username(i), f"{username(i)}@example.com", hashed_password,
+         rng.choice(zips), rng.choice(sentences), rng.choice((10, 25, 50, 100)),
+         False, now)
+        for i in range(users)
+    ), users, batch_size)
+
+    edges = power_law_edges(users, friendships, rng)
+    num_edges = len(edges) // 2
+    statuses = list(STATUS_WEIGHTS)
+    weights = list(STATUS_WEIGHTS.values())
+
+    def friendship_rows():
+        for e in range(num_edges):
+            a, b = username(edges[2 * e]), username(edges[2 * e + 1])
+            sender, recipient = (a, b) if rng.random() < 0.5 else (b, a)
+            yield (sender, recipient, rng.choices(statuses, weights)[0],
+                   min(a, b), max(a, b), now)
+
+    load_in_batches("friendships", Friendship, (
+        "sender", "recipient", "status", "user_a", "user_b", "updated_at",
+    ), friendship_rows(), num_edges, batch_size)
+
+    # Messages go between friends when there are any
+    seconds = 365 * 24 * 3600
+
+    def message_rows():
+        for _ in range(messages):
+            if num_edges:
+                e = rng.randrange(num_edges)
+                a, b = username(edges[2 * e]), username(edges[2 * e + 1])
+            else:
+                a, b = (username(i) for i in rng.sample(range(users), 2))
+            if rng.random() < 0.5:
+                a, b = b, a
+            timestamp = MESSAGES_SINCE + timedelta(seconds=rng.randrange(seconds))
+            read_at = timestamp + timedelta(seconds=rng.randrange(86400)) \
+                if rng.random() < READ_SHARE else None
+            yield (rng.choice(sentences), timestamp, timestamp, read_at, a, b,
+                   min(a, b), max(a, b))
+
+    if messages and (num_edges or users >= 2):
+        load_in_batches("messages", Message, (
+            "text", "timestamp", "updated_at", "read_at", "from_user", "to_user",
+            "user_a", "user_b",
+        ), message_rows(), messages, batch_size)
+
+    click.echo("Rebuilding conversations")
+    Conversation.rebuild()
+    db.session.commit()
+    click.echo("Done")
@@ -0,0 +1,162 @@
+"""SQLAlchemy connection pool settings and checkout-wait metrics.
+
+Pooling is set from DB_POOL_* config: a QueuePool per process by default,
+or, with DB_POOL_MODE "pgbouncer", a NullPool that leaves pooling to a
+pgbouncer in transaction mode (one server connection per transaction
+rather than per idle worker connection).
+
+Every checkout is timed; waits add up per request, so the /stats/db
+numbers show whether requests queue for connections (pool too small) or
+never do (pool bigger than needed).
+"""
+
+import threading
+import time
+
+from flask import g, has_request_context
+from sqlalchemy.pool import NullPool, QueuePool
+
+# Upper bounds (ms) of the per-request wait histogram buckets
+WAIT_BUCKETS_MS = (0.1, 1, 5, 10, 50, 100, 500, 1000, float("inf"))
+
+
+class PoolStats:
+    """Checkout wait totals, plus a histogram of wait per request"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.requests = 0
+            self.request_buckets = [0] * len(WAIT_BUCKETS_MS)
+
+    def record_checkout(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+        if has_request_context():
+            g.db_checkout_wait = g.get("db_checkout_wait", 0.0) + seconds
+
+    def record_request(self, seconds):
+        ms = seconds * 1000
+        bucket = next(i for i, bound in enumerate(WAIT_BUCKETS_MS) if ms <= bound)
+
+        with self._lock:
+            self.requests += 1
+            self.request_buckets[bucket] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "wait_ms_total": round(self.wait_seconds * 1000, 3),
+                "wait_ms_max": round(self.max_wait_seconds * 1000, 3),
+                "requests": self.requests,
+                "request_wait_ms_histogram": {
+                    ("+Inf" if bound == float("inf") else str(bound)): count
+                    for bound, count in zip(WAIT_BUCKETS_MS, self.request_buckets)
+                },
+            }
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waited"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record_checkout(time.perf_counter() - start)
+
+
+class TimedNullPool(NullPool):
+    """NullPool recording how long each connect took"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record_checkout(time.perf_counter() - start)
+
+
+def engine_options(config, database_uri):
+    """Return SQLALCHEMY_ENGINE_OPTIONS for the DB_POOL_* settings.
+
+    SQLite keeps Flask-SQLAlchemy's own pool choice (in-memory databases
+    need their single shared connection).
+    """
+
+    if not database_uri or database_uri.startswith("sqlite"):
+        return {}
+
+    options = {
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+
+    if config["DB_POOL_MODE"] == "pgbouncer":
+        options["poolclass"] = TimedNullPool
+    elif config["DB_POOL_MODE"] == "queue":
+        options.update(
+            poolclass=TimedQueuePool,
+            pool_size=config["DB_POOL_SIZE"],
+            max_overflow=config["DB_MAX_OVERFLOW"],
+            pool_timeout=config["DB_POOL_TIMEOUT"],
+            pool_recycle=config["DB_POOL_RECYCLE"],
+        )
+    else:
+        raise ValueError(f"Unknown DB_POOL_MODE: {config['DB_POOL_MODE']}")
+
+    return options
+
+
+def pool_status(engine):
+    """Return the engine pool's current occupancy"""
+
+    pool = engine.pool
+    status = {"class": type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            idle=pool.checkedin(),
+        )
+
+    return status
+
+
+def init_app(app):
+    """Apply pool settings to app config and record per-request waits.
+
+    Must run before the database is connected to app.
+    """
+
+    app.config.setdefault("DB_POOL_MODE", "queue")
+    app.config.setdefault("DB_POOL_SIZE", 5)
+    app.config.setdefault("DB_MAX_OVERFLOW", 10)
+    app.config.setdefault("DB_POOL_TIMEOUT", 30)
+    app.config.setdefault("DB_POOL_RECYCLE", 1800)
+    app.config.setdefault("DB_POOL_PRE_PING", True)
+
+    options = engine_options(app.config, app.config.get("SQLALCHEMY_DATABASE_URI"))
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(
+        options, **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+
+    @app.after_request
+    def record_checkout_wait(response):
+        if "db_checkout_wait" in g:
+            pool_stats.record_request(g.db_checkout_wait)
+        return response
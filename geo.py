@@ -0,0 +1,95 @@
+"""Zip code coordinates and a grid index for finding nearby users.
+
+Coordinates come from data/zip_coordinates.csv (zip,lat,lng), built from the
+MIT-licensed `zipcodes` package data. Zips are keyed as ints to match
+User.location, so "01234" is 1234.
+"""
+
+import csv
+import math
+import os
+from functools import lru_cache
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LAT = 69.0
+
+# Half a degree is ~35 miles north-south: small enough that a typical
+# friend_radius only touches a handful of cells.
+CELL_DEGREES = 0.5
+
+DEFAULT_ZIP_FILE = os.path.join(
+    os.path.dirname(__file__), "data", "zip_coordinates.csv")
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Return great-circle distance in miles between two points"""
+
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+
+class ZipIndex:
+    """Zip code coordinates bucketed into a lat/lng grid"""
+
+    def __init__(self, coordinates, cell_degrees=CELL_DEGREES):
+        self.coordinates = coordinates
+        self.cell_degrees = cell_degrees
+        self.cells = {}
+
+        for zip, (lat, lng) in coordinates.items():
+            self.cells.setdefault(self._cell(lat, lng), []).append(zip)
+
+    @classmethod
+    def from_csv(cls, path, cell_degrees=CELL_DEGREES):
+        """Load an index from a zip,lat,lng CSV file"""
+
+        with open(path, newline="") as f:
+            coordinates = {
+                int(row["zip"]): (float(row["lat"]), float(row["lng"]))
+                for row in csv.DictReader(f)
+            }
+
+        return cls(coordinates, cell_degrees)
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_degrees),
+                math.floor(lng / self.cell_degrees))
+
+    def within(self, zip, radius):
+        """Return {zip: distance in miles} for zips within 'radius' miles.
+
+        Only grid cells overlapping the radius's bounding box are visited.
+        Returns an empty dict for an unknown zip.
+        """
+
+        if zip not in self.coordinates:
+            return {}
+
+        lat, lng = self.coordinates[zip]
+        dlat = radius / MILES_PER_DEGREE_LAT
+        # Longitude degrees shrink towards the poles; clamp to avoid blowing
+        # up near them.
+        dlng = radius / (MILES_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 0.01))
+
+        min_row, min_col = self._cell(lat - dlat, lng - dlng)
+        max_row, max_col = self._cell(lat + dlat, lng + dlng)
+
+        nearby = {}
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                for other in self.cells.get((row, col), ()):
+                    distance = haversine(lat, lng, *self.coordinates[other])
+                    if distance <= radius:
+                        nearby[other] = distance
+
+        return nearby
+
+
+@lru_cache(maxsize=None)
+def get_zip_index(path=DEFAULT_ZIP_FILE):
+    """Return the ZipIndex for 'path', loading it on first use"""
+
+    return ZipIndex.from_csv(path)
@@ -0,0 +1,185 @@
+"""In-memory friendship graph for friend-of-friend suggestions.
+
+Accepted friendships are held as sorted arrays of compact integer user ids,
+one per user (about 8 bytes per friendship), so counting mutual friends
+over millions of edges is a few array scans rather than a self-join.
+
+The graph is loaded on first use, kept current by this process's own
+friendship changes (see models.Friendship) and reloaded every
+SUGGESTIONS_REFRESH_SECONDS to pick up other processes' changes.
+"""
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import chain
+from math import ceil
+
+# Per suggestions() call, at most this many friends are expanded and this
+# many friend-of-friend entries counted; past that, lists are sampled evenly
+# and mutual friend counts are scaled-up estimates. Keeps hubs with tens of
+# thousands of friends (and their friends) to a few milliseconds.
+MAX_FRIENDS = 2000
+MAX_WALK = 20000
+
+
+def _contains(ids, id):
+    """Whether sorted array 'ids' contains 'id'"""
+
+    i = bisect_left(ids, id)
+    return i < len(ids) and ids[i] == id
+
+
+class FriendGraph:
+    """Undirected graph of accepted friendships.
+
+    'load' returns an iterable of (username, username) pairs; it's called
+    lazily, so it may query the database.
+    """
+
+    def __init__(self, load, refresh=300, clock=time.monotonic):
+        self._load = load
+        self.refresh = refresh
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._loaded_at = None
+        self.ids = {}
+        self.names = []
+        self.adjacency = []
+
+    def init_app(self, app):
+        self.refresh = app.config.setdefault("SUGGESTIONS_REFRESH_SECONDS", 300)
+        app.extensions["friend_graph"] = self
+
+    def _id(self, username):
+        """Return username's id, assigning the next one if it's new"""
+
+        id = self.ids.get(username)
+        if id is None:
+            id = self.ids[username] = len(self.names)
+            self.names.append(username)
+            self.adjacency.append(array("i"))
+        return id
+
+    def build(self, pairs):
+        """Replace the graph with the friendships in 'pairs'"""
+
+        ids, names, neighbours = {}, [], []
+
+        for a, b in pairs:
+            for username in (a, b):
+                if username not in ids:
+                    ids[username] = len(names)
+                    names.append(username)
+                    neighbours.append([])
+            neighbours[ids[a]].append(ids[b])
+            neighbours[ids[b]].append(ids[a])
+
+        adjacency = [array("i", sorted(set(n))) for n in neighbours]
+
+        with self._lock:
+            self.ids, self.names, self.adjacency = ids, names, adjacency
+            self._loaded_at = self._clock()
+
+    def _stale(self):
+        return self._loaded_at is None or \
+            self._clock() - self._loaded_at >= self.refresh
+
+    def _ensure_loaded(self):
+        """Load the graph on first use and again once it's 'refresh' old.
+
+        One thread reloads; meanwhile the others keep using the old graph
+        (or, on first use, wait for it).
+        """
+
+        if not self._stale():
+            return
+
+        if not self._build_lock.acquire(blocking=self._loaded_at is None):
+            return
+
+        try:
+            if self._stale():
+                self.build(self._load())
+        finally:
+            self._build_lock.release()
+
+    def add_edge(self, a, b):
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            for x, y in ((self._id(a), self._id(b)), (self._id(b), self._id(a))):
+                friends = self.adjacency[x]
+                if not _contains(friends, y):
+                    friends.insert(bisect_left(friends, y), y)
+
+    def remove_edge(self, a, b):
+        with self._lock:
+            if a not in self.ids or b not in self.ids:
+                return
+            for x, y in ((self.ids[a], self.ids[b]), (self.ids[b], self.ids[a])):
+                friends = self.adjacency[x]
+                if _contains(friends, y):
+                    del friends[bisect_left(friends, y)]
+
+    def remove_user(self, username):
+        """Drop all of a deleted user's friendships (their id is kept)"""
+
+        with self._lock:
+            id = self.ids.get(username)
+            if id is None:
+                return
+            for friend in self.adjacency[id]:
+                friends = self.adjacency[friend]
+                del friends[bisect_left(friends, id)]
+            self.adjacency[id] = array("i")
+
+    def suggestions(self, username, limit):
+        """Return up to 'limit' (username, mutual friend count) pairs, most
+        mutual friends first, of users who aren't yet username's friends.
+
+        Counts are estimates for users whose friends have more than MAX_WALK
+        friends between them.
+        """
+
+        self._ensure_loaded()
+
+        with self._lock:
+            id = self.ids.get(username)
+            if id is None:
+                return []
+
+            friends = self.adjacency[id]
+            friend_step = ceil(len(friends) / MAX_FRIENDS) or 1
+            expanded = friends[::friend_step]
+
+            walk = sum(len(self.adjacency[friend]) for friend in expanded)
+            step = ceil(walk / MAX_WALK) or 1
+            counts = Counter(chain.from_iterable(
+                self.adjacency[friend][i % step::step]
+                for i, friend in enumerate(expanded)))
+
+            # Drop existing friends, looping over whichever side is smaller
+            counts.pop(id, None)
+            if len(friends) <= len(counts):
+                for friend in friends:
+                    counts.pop(friend, None)
+            else:
+                for candidate in set(friends).intersection(counts):
+                    del counts[candidate]
+
+            top = counts.most_common(limit)
+            scale = friend_step * step
+            return [(self.names[candidate], mutual * scale)
+                    for candidate, mutual in top]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self.names),
+                "friendships": sum(len(a) for a in self.adjacency) // 2,
+                "loaded": self._loaded_at is not None,
+            }
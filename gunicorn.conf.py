@@ -0,0 +1,23 @@
+"""gunicorn settings, e.g. `gunicorn wsgi:app`; see metrics.py for
+PROMETHEUS_MULTIPROC_DIR and ratelimit.py for RATELIMIT_STORAGE_URL.
+
+GET /users/<username>/events (Server-Sent Events) holds a thread for as long
+as its client stays connected, so workers run a thread pool (gthread) and
+each worker serves up to GUNICORN_THREADS requests at once, open event
+streams included. Idle streams only wait on a condition variable, so a
+thread costs little more than its stack; size GUNICORN_THREADS x workers for
+the expected number of connected clients plus ordinary traffic.
+"""
+
+import os
+import tempfile
+
+from metrics import child_exit
+
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 256))
+
+# Share rate limit budgets between the workers (and across restarts)
+os.environ.setdefault(
+    "RATELIMIT_STORAGE_URL",
+    "mmap://" + os.path.join(tempfile.gettempdir(), "friender-ratelimit"))
@@ -0,0 +1,169 @@
+"""Password hashing offloaded to a bounded process pool.
+
+bcrypt is deliberately CPU-heavy; running it on request threads lets a burst
+of logins pin every worker. PasswordHasher runs it in a small process pool
+instead and sheds load (HashingBusy) once too many hashes are queued.
+
+The pool's processes come from a forkserver, not a fork of the server
+worker: workers run many threads (gunicorn.conf.py), and a child forked
+while another thread holds a lock (logging, imports, a database driver)
+can deadlock on it. The costs: a slower first hash per worker while the
+forkserver starts, and, as with any spawned process, children import the
+main module, so scripts that hash through the pool need an
+`if __name__ == "__main__"` guard (server and flask CLI entry points have
+one).
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+from metrics import password_hash_seconds
+
+DEFAULT_ROUNDS = 12
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full or a hash timed out"""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(
+        password.encode("UTF-8"), bcrypt.gensalt(rounds)).decode("UTF-8")
+
+
+def _check(hashed_password, password):
+    return bcrypt.checkpw(password.encode("UTF-8"), hashed_password.encode("UTF-8"))
+
+
+def hash_rounds(hashed_password):
+    """Return the cost factor of a bcrypt hash like '$2b$12$...'"""
+
+    return int(hashed_password.split("$")[2])
+
+
+class PasswordHasher:
+    """Hash and check passwords in a process pool, with backpressure.
+
+    Config:
+    - BCRYPT_LOG_ROUNDS: cost factor for new hashes; stored hashes with any
+      other cost are reported by needs_rehash
+    - HASH_POOL_WORKERS: pool processes; 0 hashes inline on the caller
+    - HASH_POOL_MAX_PENDING: queued + running hashes before HashingBusy
+    - HASH_POOL_TIMEOUT: seconds to wait for a result before HashingBusy
+    """
+
+    def __init__(self, app=None):
+        self.rounds = DEFAULT_ROUNDS
+        self.workers = 0
+        self.max_pending = 0
+        self.timeout = None
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._seconds = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read pool settings from app config"""
+
+        workers = os.cpu_count() or 1
+
+        self.rounds = app.config.setdefault("BCRYPT_LOG_ROUNDS", DEFAULT_ROUNDS)
+        self.workers = app.config.setdefault("HASH_POOL_WORKERS", workers)
+        self.max_pending = app.config.setdefault(
+            "HASH_POOL_MAX_PENDING", self.workers * 4)
+        self.timeout = app.config.setdefault("HASH_POOL_TIMEOUT", 10)
+
+        app.extensions["password_hasher"] = self
+
+    def _run(self, fn, *args):
+        """Run fn(*args) in the pool and wait for its result"""
+
+        start = time.perf_counter()
+
+        if not self.workers:
+            result = fn(*args)
+            with self._lock:
+                self._submitted += 1
+                self._seconds += time.perf_counter() - start
+            return result
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                raise HashingBusy("Too many password hashes queued")
+
+            # Created on first use so each forked server worker gets its own
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("forkserver"))
+
+            self._pending += 1
+            self._submitted += 1
+
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+
+        try:
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self._timed_out += 1
+            raise HashingBusy("Timed out waiting for password hash")
+
+        with self._lock:
+            self._seconds += time.perf_counter() - start
+
+        return result
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def generate_password_hash(self, password):
+        """Return a bcrypt hash of 'password' at the configured cost"""
+
+        start = time.perf_counter()
+        hashed_password = self._run(_hash, password, self.rounds)
+        password_hash_seconds.labels("hash").observe(time.perf_counter() - start)
+        return hashed_password
+
+    def check_password_hash(self, hashed_password, password):
+        """Return True if 'password' matches 'hashed_password'"""
+
+        start = time.perf_counter()
+        matches = self._run(_check, hashed_password, password)
+        password_hash_seconds.labels("check").observe(time.perf_counter() - start)
+        return matches
+
+    def needs_rehash(self, hashed_password):
+        """Return True if 'hashed_password' wasn't made at the current cost"""
+
+        return hash_rounds(hashed_password) != self.rounds
+
+    def stats(self):
+        """Return queue depth and throughput counters"""
+
+        with self._lock:
+            return {
+                "rounds": self.rounds,
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self._pending,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "seconds": round(self._seconds, 3),
+            }
@@ -0,0 +1,130 @@
+"""Prometheus metrics, served at /metrics.
+
+Request latency and counts per Flask endpoint, in-flight requests, database
+pool occupancy and checkout waits, photo upload time and size, and bcrypt
+hashing time. Metric updates are a lock-guarded add per observation, with
+no work at all until a scrape.
+
+Under gunicorn (or any pre-fork server) set PROMETHEUS_MULTIPROC_DIR to an
+empty directory before the server starts: every worker then writes its
+values to memory-mapped files there and /metrics adds them up across
+workers. gunicorn.conf.py cleans up after exited workers.
+"""
+
+import os
+import time
+
+from flask import current_app, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+    REGISTRY, generate_latest, multiprocess
+)
+
+# Upper bounds (bytes) of the photo upload size buckets
+SIZE_BUCKETS = (10e3, 50e3, 100e3, 250e3, 500e3, 1e6, 2.5e6, 5e6, 10e6)
+
+request_seconds = Histogram(
+    "friender_http_request_duration_seconds",
+    "Time to build a response, by Flask endpoint",
+    ["endpoint", "method"])
+
+requests_total = Counter(
+    "friender_http_requests_total",
+    "Responses sent, by Flask endpoint and status code",
+    ["endpoint", "method", "status"])
+
+requests_in_flight = Gauge(
+    "friender_http_requests_in_flight",
+    "Requests being handled",
+    multiprocess_mode="livesum")
+
+db_pool_connections = Gauge(
+    "friender_db_pool_connections",
+    "Database pool connections at the end of the last request, by state",
+    ["bind", "state"],
+    multiprocess_mode="livesum")
+
+db_checkout_wait_seconds = Histogram(
+    "friender_db_checkout_wait_seconds",
+    "Time a request spent waiting for database connections",
+    buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, float("inf")))
+
+photo_upload_seconds = Histogram(
+    "friender_photo_upload_duration_seconds",
+    "Time to store one photo variant",
+    ["backend"])
+
+photo_upload_bytes = Histogram(
+    "friender_photo_upload_bytes",
+    "Size of each stored photo variant",
+    ["backend"],
+    buckets=SIZE_BUCKETS)
+
+password_hash_seconds = Histogram(
+    "friender_password_hash_duration_seconds",
+    "Time to hash or check a password, including any wait for the pool",
+    ["operation"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf")))
+
+
+def render():
+    """Return (body, content type) of every metric, across all processes
+    when PROMETHEUS_MULTIPROC_DIR is set"""
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def child_exit(server, worker):
+    """gunicorn hook: drop an exited worker's live gauges"""
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def record_pool(engines):
+    """Set pool gauges from {bind key: engine}"""
+
+    for bind, engine in engines.items():
+        pool = engine.pool
+        if not hasattr(pool, "checkedout"):
+            continue
+        bind = bind or "primary"
+        db_pool_connections.labels(bind, "checked_out").set(pool.checkedout())
+        db_pool_connections.labels(bind, "idle").set(pool.checkedin())
+        db_pool_connections.labels(bind, "overflow").set(max(pool.overflow(), 0))
+
+
+def init_app(app):
+    """Time app's requests. METRICS_TOKEN, when set, is the bearer token
+    /metrics requires."""
+
+    app.config.setdefault("METRICS_TOKEN", None)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+        requests_in_flight.inc()
+
+    @app.after_request
+    def record_request_metrics(response):
+        if "metrics_start" in g:
+            endpoint = request.endpoint or "unmatched"
+            request_seconds.labels(endpoint, request.method).observe(
+                time.perf_counter() - g.metrics_start)
+            requests_total.labels(
+                endpoint, request.method, response.status_code).inc()
+        if "db_checkout_wait" in g:
+            db_checkout_wait_seconds.observe(g.db_checkout_wait)
+        record_pool(current_app.extensions["sqlalchemy"].engines)
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        if g.pop("metrics_start", None) is not None:
+            requests_in_flight.dec()
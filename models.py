@@ -1,12 +1,148 @@
 """SQLAlchemy models for Friender"""
 
+import uuid
 from datetime import datetime
-from flask_bcrypt import Bcrypt
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_, join
+from sqlalchemy import (
+    and_, case, delete, event, exists, func, insert, or_, join, select, tuple_,
+    union, union_all, update
+)
+from cache import MISSING, TTLCache
+from graph import FriendGraph
+from hashing import PasswordHasher
+from pubsub import PubSub
+from replicas import ReplicaRouter, RoutingSession
+from serialization import records
+from pagination import (
+    DEFAULT_LIMIT, PaginationError, decode_cursor, encode_cursor
+)
+from werkzeug.local import LocalProxy
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+
+def extension(name):
+    """Proxy to the current app's app.extensions[name].
+
+    Each app made by create_app has its own hasher, broker, caches and so
+    on, so apps with different configs can live side by side (tests, a
+    worker per config); these module-level names find the current one.
+    """
+
+    return LocalProxy(lambda: current_app.extensions[name])
+
+
+hasher = extension("password_hasher")
+pubsub = extension("pubsub")
+replica_router = extension("replicas")
+
+# Serialized users by username; None marks a username known not to exist
+user_cache = extension("user_cache")
+
+# Accepted friendships, for suggestions; loaded on first use
+friend_graph = extension("friend_graph")
+
+
+def init_extensions(app):
+    """Give app its own instances of the extensions above.
+
+    Must run before the database is connected to app (replica binds).
+    """
+
+    ReplicaRouter().init_app(app)
+    PasswordHasher().init_app(app)
+    PubSub().init_app(app)
+    app.extensions["user_cache"] = TTLCache(
+        app.config.setdefault("USER_CACHE_SIZE", 10000),
+        app.config.setdefault("USER_CACHE_TTL", 30))
+    FriendGraph(load=lambda: Friendship.accepted_pairs()).init_app(app)
+
+# Suggestions ranked by mutual friends are fetched this many times over
+# before excluding pending/rejected requests and applying proximity boosts
+SUGGESTION_POOL_FACTOR = 5
+
+# A suggestion in the same zip scores (1 + boost) times its mutual friend
+# count, falling linearly to 1x at the edge of the user's friend_radius
+PROXIMITY_BOOST = 1.0
+
+
+def on_commit(fn):
+    """Call fn() once the current transaction commits (dropped on rollback)"""
+
+    db.session.info.setdefault("on_commit", []).append(fn)
+
+
+@event.listens_for(db.session, "after_commit")
+def _run_on_commit(session):
+    for fn in session.info.pop("on_commit", []):
+        fn()
+
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_on_commit(session):
+    session.info.pop("on_commit", None)
+
+
+def publish_on_commit(usernames, type, data):
+    """Push an event to each user's channel once the transaction commits"""
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+    event = {"type": type, "data": data}
+
+    def publish():
+        for username in set(usernames):
+            pubsub.publish(username, event)
+
+    on_commit(publish)
+
+
+def sync_friend_graph(friendship):
+    """Mirror a friendship's status into friend_graph once committed"""
+
+    sender, recipient = friendship.sender, friendship.recipient
+
+    if friendship.status == "accepted":
+        on_commit(lambda: friend_graph.add_edge(sender, recipient))
+    else:
+        on_commit(lambda: friend_graph.remove_edge(sender, recipient))
+
+
+def invalidate_user(username):
+    """Drop a cached user now and again after commit, so a concurrent read
+    can't re-cache the pre-commit row"""
+
+    user_cache.delete(username)
+    on_commit(lambda: user_cache.delete(username))
+
+
+def select_serialized(query, model, *extra):
+    """Make a select(model) query return plain rows of the columns
+    model.serialize() reads, followed by any 'extra' columns.
+
+    Skips building ORM objects; serialization.records() turns the rows into
+    the same dicts serialize() would.
+    """
+
+    columns = [getattr(model, name) for name in model.serialized_columns]
+
+    return query.with_only_columns(*columns, *extra)
+
+
+def select_version(query, model):
+    """Build a select summarizing the rows a select(model) query returns as
+    (count, latest updated_at, lowest key, highest key).
+
+    Any insert, update or delete that changes which rows the query returns,
+    or their contents, changes the summary; it makes a cheap validator for a
+    whole page.
+    """
+
+    key = model.__mapper__.primary_key[0]
+    rows = query.with_only_columns(
+        key.label("key"), model.updated_at.label("updated_at")).subquery()
+
+    return select(func.count(), func.max(rows.c.updated_at),
+                  func.min(rows.c.key), func.max(rows.c.key))
 
 
 class User(db.Model):
@@ -32,7 +168,8 @@ class User(db.Model):
 
     location = db.Column(
         db.Integer,
-        nullable=False
+        nullable=False,
+        index=True
     )
 
     bio = db.Column(
@@ -54,6 +191,14 @@ class User(db.Model):
         nullable=False
     )
 
+    # Row version: bumped by every UPDATE, for ETag / Last-Modified
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow
+    )
+
     sent_messages = db.relationship(
         "Message", foreign_keys="Message.from_user", backref="sent_by"
     )
@@ -62,6 +207,10 @@ class User(db.Model):
         "Message", foreign_keys="Message.to_user", backref="received_by"
     )
 
+    # Columns serialize() reads, in order; see select_serialized
+    serialized_columns = (
+        "username", "email", "location", "bio", "friend_radius", "photo")
+
     def serialize(self):
         """Serialize to dictionary"""
 
@@ -98,7 +247,7 @@ class User(db.Model):
     def register(cls, username, email, password, location, bio, friend_radius, photo, is_admin):
         """Registers new user and adds them to db"""
 
-        hashed_password = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_password = hasher.generate_password_hash(password)
 
         new_user = User(
             username=username,
@@ -112,6 +261,8 @@ class User(db.Model):
         )
 
         db.session.add(new_user)
+        invalidate_user(username)
+
         return new_user
 
     @classmethod
@@ -119,14 +270,17 @@ class User(db.Model):
         """Find user with 'username' and 'password'.
 
         If user is found, check if stored hashed_password matches password.
-        If yes, return user object, otherwise return false.
+        If yes, return user object, otherwise return false. A matching hash
+        made at an outdated cost factor is replaced with a fresh one.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.hashed_password, password)
+            is_auth = hasher.check_password_hash(user.hashed_password, password)
             if is_auth:
+                if hasher.needs_rehash(user.hashed_password):
+                    user.hashed_password = hasher.generate_password_hash(password)
                 return user
 
         return False
@@ -141,6 +295,13 @@ class User(db.Model):
         return users
 
 
+    @classmethod
+    def select_all(cls):
+        """Build a select for all users"""
+
+        return select(User)
+
+
     @classmethod
     def get(cls, username):
         """Return a specific user"""
@@ -150,6 +311,23 @@ class User(db.Model):
         return user
 
 
+    @classmethod
+    def get_cached(cls, username):
+        """Return a specific user serialized, or None if there isn't one.
+
+        Answers from user_cache when it can, caching misses too.
+        """
+
+        serialized = user_cache.get(username)
+
+        if serialized is MISSING:
+            user = db.session.get(User, username)
+            serialized = user.serialize() if user else None
+            user_cache.set(username, serialized)
+
+        return serialized
+
+
     @classmethod
     def update(cls, username, data):
         """Update data for a specific user"""
@@ -161,6 +339,7 @@ class User(db.Model):
         updated_user.bio = data.get("bio", updated_user.bio)
         updated_user.friend_radius = data.get("friend_radius", updated_user.friend_radius)
         updated_user.photo = data.get("photo", updated_user.photo)
+        invalidate_user(username)
 
         return updated_user
 
@@ -171,41 +350,200 @@ class User(db.Model):
 
         user = User.query.get_or_404(username)
         db.session.delete(user)
+        invalidate_user(username)
+        on_commit(lambda: friend_graph.remove_user(username))
 
         return username
 
 
     @classmethod
-    def messages(cls, username):
-        """Get all messages from a user"""
+    def messages(cls, username, after=None, limit=DEFAULT_LIMIT):
+        """Get a page of messages sent or received by a user, oldest first"""
 
-        return db.session.query(Message)\
-            .join(User, User.username == Message.from_user)\
-            .filter(or_(Message.from_user == username, Message.to_user == username))\
-            .all()
+        return Message.page(username=username, after=after, limit=limit)
 
 
     @classmethod
-    def friends(cls, username):
-        """Return array of all accepted friends"""
+    def friends(cls, username, after=None, limit=DEFAULT_LIMIT):
+        """Return a page of accepted friends, ordered by username.
+
+        'after' is a cursor from User.cursor.
+        """
+
+        query = User.select_friends(username, after=after, limit=limit)
 
-        sender_friends = db.session.query(User)\
-            .join(Friendship, User.username == Friendship.sender)\
-            .filter(or_(Friendship.sender == username, Friendship.recipient == username),\
-                Friendship.status == 'accepted',\
-                Friendship.recipient == username)\
-            .all()
-        recipient_friends = db.session.query(User)\
-            .join(Friendship, User.username == Friendship.recipient)\
-            .filter(or_(Friendship.sender == username, Friendship.recipient == username),\
-                Friendship.status == 'accepted',\
-                Friendship.sender == username)\
-            .all()
-        return sender_friends + recipient_friends
+        return db.session.scalars(query).all()
+
+
+    @classmethod
+    def select_friends(cls, username, after=None, limit=DEFAULT_LIMIT):
+        """Build a select for a page of accepted friends, ordered by username.
+
+        Both directions of the friendship are looked up in one UNION query
+        (which also drops duplicate edges), each side served by its
+        (sender|recipient, status) index.
+        """
+
+        sent = select(Friendship.recipient.label("friend"))\
+            .filter(Friendship.sender == username, Friendship.status == 'accepted')
+        received = select(Friendship.sender.label("friend"))\
+            .filter(Friendship.recipient == username, Friendship.status == 'accepted')
+
+        if after is not None:
+            (last_username,) = decode_cursor(after, 1)
+            sent = sent.filter(Friendship.recipient > str(last_username))
+            received = received.filter(Friendship.sender > str(last_username))
+
+        # Each half seeks its index and stops at 'limit' rows, so a page costs
+        # O(limit) no matter how many friends the user has.
+        sent = sent.order_by("friend").limit(limit).subquery()
+        received = received.order_by("friend").limit(limit).subquery()
+        friend_names = union(
+            select(sent.c.friend), select(received.c.friend)).subquery()
+
+        return select(User)\
+            .join(friend_names, User.username == friend_names.c.friend)\
+            .order_by(User.username)\
+            .limit(limit)
+
+
+    @classmethod
+    def nearby(cls, username, locations, after=None, limit=DEFAULT_LIMIT):
+        """Return a page of users located in any of 'locations', by username.
+
+        'after' is a cursor from User.cursor.
+        """
+
+        query = User.select_nearby(username, locations, after=after, limit=limit)
+
+        return db.session.scalars(query).all()
+
+
+    @classmethod
+    def select_nearby(cls, username, locations, after=None, limit=DEFAULT_LIMIT):
+        """Build a select for a page of users in any of 'locations'.
+
+        Excludes the user themself and anyone they already have a friendship
+        with in either direction, whatever its status.
+        """
+
+        connected = exists().where(or_(
+            and_(Friendship.sender == username, Friendship.recipient == User.username),
+            and_(Friendship.recipient == username, Friendship.sender == User.username),
+        ))
+
+        query = select(User)\
+            .filter(User.location.in_(list(locations)),
+                User.username != username,
+                ~connected)\
+            .order_by(User.username)
+
+        if after is not None:
+            (last_username,) = decode_cursor(after, 1)
+            query = query.filter(User.username > str(last_username))
+
+        return query.limit(limit)
+
+
+    @classmethod
+    def suggestions(cls, username, limit=DEFAULT_LIMIT, distances=None, radius=None):
+        """Return up to 'limit' friends-of-friends to suggest, best first.
+
+        Each is the user serialized plus 'mutual_friends' and 'score'.
+        Candidates come from friend_graph, ranked by mutual friend count;
+        anyone with a friendship row with username (pending or rejected
+        too) is left out. With 'distances' ({zip: miles}, as from
+        ZipIndex.within) and 'radius', users nearby get a boost of up to
+        PROXIMITY_BOOST and a 'distance'.
+        """
+
+        candidates = dict(
+            friend_graph.suggestions(username, limit * SUGGESTION_POOL_FACTOR))
+        if not candidates:
+            return []
+
+        names = list(candidates)
+        requested = db.session.execute(
+            select(Friendship.sender, Friendship.recipient)
+            .filter(or_(
+                and_(Friendship.sender == username, Friendship.recipient.in_(names)),
+                and_(Friendship.recipient == username, Friendship.sender.in_(names)),
+            ))).all()
+        for sender, recipient in requested:
+            candidates.pop(recipient if sender == username else sender, None)
+
+        rows = db.session.execute(select_serialized(
+            select(User).filter(User.username.in_(list(candidates))), User)).all()
+
+        suggestions = []
+        for suggestion in records(rows, User.serialized_columns):
+            mutual = candidates[suggestion["username"]]
+            score = float(mutual)
+
+            if distances is not None and suggestion["location"] in distances:
+                miles = distances[suggestion["location"]]
+                closeness = 1 - miles / radius if radius else 1
+                score = mutual * (1 + PROXIMITY_BOOST * closeness)
+                suggestion["distance"] = round(miles, 1)
+
+            suggestion.update(mutual_friends=mutual, score=round(score, 3))
+            suggestions.append(suggestion)
+
+        suggestions.sort(key=lambda s: (-s["score"], s["username"]))
+
+        return suggestions[:limit]
+
+
+    @classmethod
+    def cursor(cls, user):
+        """Return the cursor that continues a page of users after 'user'"""
+
+        return encode_cursor(user.username)
 
 
 #########  Message Class  ##########
 
+MESSAGE_MAX_LENGTH = 140
+
+
+def _pair_default(pick, first, second):
+    """Column default filling in pick(first, second) from the inserted row"""
+
+    def default(context):
+        params = context.get_current_parameters()
+        return pick(params[first], params[second])
+
+    return default
+
+
+def conversation_pair(username, other):
+    """Return the (user_a, user_b) key of the conversation between two users"""
+
+    return min(username, other), max(username, other)
+
+
+def decode_timestamp_cursor(cursor):
+    """Decode a (timestamp, id) cursor made by Message.cursor"""
+
+    timestamp, id = decode_cursor(cursor, 2)
+
+    try:
+        return datetime.fromisoformat(timestamp), int(id)
+    except (TypeError, ValueError):
+        raise PaginationError(f"Invalid cursor: {cursor}")
+
+
+def dialect_insert(model):
+    """Return an INSERT for model that supports on_conflict_do_* upserts"""
+
+    if db.session.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+
+    return upsert(model)
+
+
 class Message(db.Model):
     """Messages sent from one User to another"""
 
@@ -218,7 +556,7 @@ class Message(db.Model):
     )
 
     text = db.Column(
-        db.String(140),
+        db.String(MESSAGE_MAX_LENGTH),
         nullable=False
     )
 
@@ -228,6 +566,21 @@ class Message(db.Model):
         default=datetime.utcnow
     )
 
+    # Row version: bumped by every UPDATE, for ETag / Last-Modified
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow
+    )
+
+    # Read receipt: when to_user marked the message read (see
+    # Conversation.mark_read)
+    read_at = db.Column(
+        db.DateTime,
+        nullable=True
+    )
+
     from_user = db.Column(
         db.Text,
         db.ForeignKey('users.username', ondelete='CASCADE'),
@@ -240,6 +593,37 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # The conversation's users in sorted order, i.e. least(from_user,
+    # to_user) and greatest(from_user, to_user), filled in on insert
+    user_a = db.Column(
+        db.Text,
+        nullable=False,
+        default=_pair_default(min, "from_user", "to_user")
+    )
+
+    user_b = db.Column(
+        db.Text,
+        nullable=False,
+        default=_pair_default(max, "from_user", "to_user")
+    )
+
+    # Keyset pagination walks (timestamp, id). A user's page is a UNION ALL
+    # of one seek into each per-user index (see Message.select_after), so it
+    # reads O(limit) rows instead of sorting all their messages; the pair
+    # index does the same for a single conversation.
+    __table_args__ = (
+        db.Index('ix_messages_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_messages_from_user_timestamp_id',
+                 'from_user', 'timestamp', 'id'),
+        db.Index('ix_messages_to_user_timestamp_id',
+                 'to_user', 'timestamp', 'id'),
+        db.Index('ix_messages_pair_timestamp_id',
+                 'user_a', 'user_b', 'timestamp', 'id'),
+    )
+
+    # Columns serialize() reads, in order; see select_serialized
+    serialized_columns = ("id", "text", "from_user", "to_user")
+
     def serialize(self):
             """Serialize Message to dictionary"""
 
@@ -252,11 +636,84 @@ class Message(db.Model):
 
 
     @classmethod
-    def all(cls):
-        """Return all messages"""
-        messages = Message.query.all()
+    def all(cls, after=None, limit=DEFAULT_LIMIT):
+        """Return a page of all messages, oldest first"""
+
+        return Message.page(after=after, limit=limit)
+
+
+    @classmethod
+    def cursor(cls, message):
+        """Return the cursor that continues after 'message'"""
 
-        return messages
+        return encode_cursor(message.timestamp, message.id)
+
+
+    @classmethod
+    def select_after(cls, username=None, after=None, limit=None):
+        """Build a select for up to 'limit' messages ordered by (timestamp, id).
+
+        Optionally restrict to messages involving 'username' and start after
+        the cursor 'after'.
+
+        A user's messages are looked up as a UNION ALL of the ones they sent
+        and the ones they received (less those sent to themself, already in
+        the first half), each side an ordered seek into its (from_user|
+        to_user, timestamp, id) index that stops at 'limit' rows.
+        """
+
+        keyset = None
+        if after is not None:
+            timestamp, id = decode_timestamp_cursor(after)
+            keyset = tuple_(Message.timestamp, Message.id) > tuple_(timestamp, id)
+
+        query = select(Message).order_by(Message.timestamp, Message.id)
+
+        if username is not None:
+            sides = [
+                select(Message.id).filter(Message.from_user == username),
+                select(Message.id).filter(Message.to_user == username,
+                                          Message.from_user != username),
+            ]
+            if keyset is not None:
+                sides = [side.filter(keyset) for side in sides]
+            sides = [side.order_by(Message.timestamp, Message.id).limit(limit)
+                     for side in sides]
+            ids = union_all(*(select(side.subquery()) for side in sides)).subquery()
+            query = query.join(ids, Message.id == ids.c.id)
+        elif keyset is not None:
+            query = query.filter(keyset)
+
+        return query.limit(limit)
+
+
+    @classmethod
+    def thread(cls, username, other, after=None, limit=DEFAULT_LIMIT):
+        """Return a page of messages between two users, newest first.
+
+        'after' is the cursor of the last message on the previous page.
+        """
+
+        user_a, user_b = conversation_pair(username, other)
+        query = select(Message)\
+            .filter(Message.user_a == user_a, Message.user_b == user_b)\
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+
+        if after is not None:
+            timestamp, id = decode_timestamp_cursor(after)
+            query = query.filter(
+                tuple_(Message.timestamp, Message.id) < tuple_(timestamp, id))
+
+        return db.session.scalars(query.limit(limit)).all()
+
+
+    @classmethod
+    def page(cls, username=None, after=None, limit=DEFAULT_LIMIT):
+        """Return up to 'limit' messages after the cursor 'after'"""
+
+        query = Message.select_after(username=username, after=after, limit=limit)
+
+        return db.session.scalars(query).all()
 
 
     @classmethod
@@ -278,9 +735,351 @@ class Message(db.Model):
         )
 
         db.session.add(message)
+        db.session.flush()
+        Conversation.record([message])
+        publish_on_commit([from_user, to_user], "message", message.serialize())
 
         return message
 
+    @classmethod
+    def create_many(cls, messages):
+        """Create many messages with one user lookup and batched inserts.
+
+        'messages' is a list of dicts with from_user, to_user and text.
+        Returns a list with, for each item in order, either {"id": ...} or
+        {"Error": ...}; invalid items don't stop valid ones being inserted.
+        """
+
+        results, valid = Message.validate_many(messages)
+        Message.insert_many(results, valid)
+
+        return results
+
+
+    @classmethod
+    def validate_many(cls, messages):
+        """Check items for create_many, with one user lookup.
+
+        Returns (results, valid): results has {"Error": ...} for each invalid
+        item and None for the rest; valid is a list of (index, row to insert).
+        """
+
+        results = [None] * len(messages)
+        usernames = set()
+
+        for i, item in enumerate(messages):
+            if not isinstance(item, dict) or not all(
+                    isinstance(item.get(key), str)
+                    for key in ("from_user", "to_user", "text")):
+                results[i] = {"Error": "from_user, to_user and text are required"}
+            elif len(item["text"]) > MESSAGE_MAX_LENGTH:
+                results[i] = {
+                    "Error": f"text is longer than {MESSAGE_MAX_LENGTH} characters"}
+            else:
+                usernames.update((item["from_user"], item["to_user"]))
+
+        existing = set(db.session.scalars(
+            select(User.username).filter(User.username.in_(usernames))))
+
+        valid = []
+        for i, item in enumerate(messages):
+            if results[i] is not None:
+                continue
+
+            missing = [item[key] for key in ("from_user", "to_user")
+                       if item[key] not in existing]
+            if missing:
+                results[i] = {"Error": f"No such user: {', '.join(missing)}"}
+            else:
+                valid.append((i, dict(
+                    from_user=item["from_user"],
+                    to_user=item["to_user"],
+                    text=item["text"],
+                )))
+
+        return results, valid
+
+
+    @classmethod
+    def insert_many(cls, results, valid):
+        """Insert validate_many's valid rows, filling in their ids in results"""
+
+        if not valid:
+            return
+
+        indexes = [i for i, _ in valid]
+        rows = [row for _, row in valid]
+        inserted = db.session.execute(
+            insert(Message).returning(
+                Message.id,
+                Message.timestamp,
+                Message.from_user,
+                Message.to_user,
+                sort_by_parameter_order=True),
+            rows).all()
+
+        for i, row, values in zip(indexes, inserted, rows):
+            results[i] = {"id": row.id}
+            publish_on_commit([row.from_user, row.to_user], "message", {
+                "id": row.id,
+                "text": values["text"],
+                "from_user": row.from_user,
+                "to_user": row.to_user,
+            })
+
+        Conversation.record(inserted)
+
+
+class Conversation(db.Model):
+    """Latest message and unread counts between a pair of users.
+
+    One row per pair, kept up to date by Message.create / create_many, so
+    listing a user's conversations or unread badges never has to group the
+    messages table.
+    """
+
+    __tablename__ = 'conversations'
+
+    user_a = db.Column(
+        db.Text,
+        db.ForeignKey('users.username', ondelete='CASCADE'),
+        primary_key=True
+    )
+
+    user_b = db.Column(
+        db.Text,
+        db.ForeignKey('users.username', ondelete='CASCADE'),
+        primary_key=True
+    )
+
+    last_message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        nullable=False
+    )
+
+    last_timestamp = db.Column(
+        db.DateTime,
+        nullable=False
+    )
+
+    # Messages to user_a / user_b they haven't read yet, counted by
+    # Conversation.record and mark_read in the same transactions that
+    # insert or read the messages
+    unread_a = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0"
+    )
+
+    unread_b = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0"
+    )
+
+    last_message = db.relationship("Message")
+
+    __table_args__ = (
+        db.Index('ix_conversations_user_a_last', 'user_a', 'last_timestamp',
+                 'last_message_id'),
+        db.Index('ix_conversations_user_b_last', 'user_b', 'last_timestamp',
+                 'last_message_id'),
+    )
+
+    def serialize(self):
+        """Serialize to dictionary"""
+
+        return {
+        "users": [self.user_a, self.user_b],
+        "last_message": self.last_message.serialize(),
+        "last_timestamp": self.last_timestamp.isoformat(),
+        "unread": {self.user_a: self.unread_a, self.user_b: self.unread_b},
+        }
+
+    @classmethod
+    def record(cls, messages):
+        """Upsert the conversations of newly inserted messages.
+
+        'messages' need id, timestamp, from_user and to_user. A pair's
+        latest message only moves forward, so concurrent writers can't
+        regress it, and its unread counts go up by the messages to each user.
+        """
+
+        latest = {}
+        unread = {}
+        for m in messages:
+            pair = conversation_pair(m.from_user, m.to_user)
+            if pair not in latest or \
+                    (m.timestamp, m.id) > (latest[pair].timestamp, latest[pair].id):
+                latest[pair] = m
+            counts = unread.setdefault(pair, [0, 0])
+            counts[m.to_user != pair[0]] += 1
+
+        if not latest:
+            return
+
+        stmt = dialect_insert(Conversation)
+        newer = tuple_(stmt.excluded.last_timestamp, stmt.excluded.last_message_id) > \
+            tuple_(Conversation.last_timestamp, Conversation.last_message_id)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Conversation.user_a, Conversation.user_b],
+            set_={
+                "last_message_id": case(
+                    (newer, stmt.excluded.last_message_id),
+                    else_=Conversation.last_message_id),
+                "last_timestamp": case(
+                    (newer, stmt.excluded.last_timestamp),
+                    else_=Conversation.last_timestamp),
+                "unread_a": Conversation.unread_a + stmt.excluded.unread_a,
+                "unread_b": Conversation.unread_b + stmt.excluded.unread_b,
+            },
+        )
+
+        db.session.execute(stmt, [
+            dict(user_a=user_a, user_b=user_b,
+                 last_message_id=m.id, last_timestamp=m.timestamp,
+                 unread_a=unread[user_a, user_b][0],
+                 unread_b=unread[user_a, user_b][1])
+            for (user_a, user_b), m in latest.items()
+        ])
+
+    @classmethod
+    def mark_read(cls, username, other, up_to=None):
+        """Mark username's unread messages from other read, up to message id
+        'up_to' if given; return how many were marked.
+
+        The conversation's unread count goes down by the same number in the
+        same transaction, and other gets a "read" event.
+        """
+
+        user_a, user_b = conversation_pair(username, other)
+        stmt = update(Message)\
+            .filter(Message.user_a == user_a, Message.user_b == user_b,
+                    Message.to_user == username, Message.read_at.is_(None))\
+            .values(read_at=datetime.utcnow())\
+            .execution_options(synchronize_session=False)
+
+        if up_to is not None:
+            stmt = stmt.filter(Message.id <= up_to)
+
+        marked = db.session.execute(stmt).rowcount
+
+        if marked:
+            counter = Conversation.unread_a if username == user_a \
+                else Conversation.unread_b
+            db.session.execute(update(Conversation)
+                .filter(Conversation.user_a == user_a,
+                        Conversation.user_b == user_b)
+                .values({counter: counter - marked})
+                .execution_options(synchronize_session=False))
+            publish_on_commit([other], "read", {
+                "by": username, "count": marked, "up_to": up_to})
+
+        return marked
+
+    @classmethod
+    def unread_summary(cls, username):
+        """Return username's conversations with unread messages, most recent
+        first, as dicts of the other user, unread count and latest message.
+
+        Reads only the counters: one row per conversation, no messages.
+        """
+
+        unread = case((Conversation.user_a == username, Conversation.unread_a),
+                      else_=Conversation.unread_b)
+        other = case((Conversation.user_a == username, Conversation.user_b),
+                     else_=Conversation.user_a)
+
+        rows = db.session.execute(
+            select(other.label("user"), unread.label("unread"),
+                   Conversation.last_message_id, Conversation.last_timestamp)
+            .filter(or_(
+                and_(Conversation.user_a == username, Conversation.unread_a > 0),
+                and_(Conversation.user_b == username, Conversation.unread_b > 0)))
+            .order_by(Conversation.last_timestamp.desc(),
+                      Conversation.last_message_id.desc())).all()
+
+        return [{
+            "user": row.user,
+            "unread": row.unread,
+            "last_message_id": row.last_message_id,
+            "last_timestamp": row.last_timestamp.isoformat(),
+        } for row in rows]
+
+    @classmethod
+    def for_user(cls, username, after=None, limit=DEFAULT_LIMIT):
+        """Return a page of a user's conversations, most recent first.
+
+        'after' is a cursor from Conversation.cursor.
+        """
+
+        query = select(Conversation)\
+            .filter(or_(Conversation.user_a == username,
+                        Conversation.user_b == username))\
+            .order_by(Conversation.last_timestamp.desc(),
+                      Conversation.last_message_id.desc())
+
+        if after is not None:
+            timestamp, id = decode_timestamp_cursor(after)
+            query = query.filter(
+                tuple_(Conversation.last_timestamp, Conversation.last_message_id) <
+                tuple_(timestamp, id))
+
+        return db.session.scalars(
+            query.options(db.joinedload(Conversation.last_message)).limit(limit)
+        ).all()
+
+    @classmethod
+    def cursor(cls, conversation):
+        """Return the cursor that continues after 'conversation'"""
+
+        return encode_cursor(
+            conversation.last_timestamp, conversation.last_message_id)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every conversation from the messages table.
+
+        For backfilling after a migration; normal writes keep the table
+        current incrementally.
+        """
+
+        pair = (Message.user_a, Message.user_b)
+
+        def unread_to(user):
+            return db.func.sum(case(
+                (and_(Message.to_user == user, Message.read_at.is_(None)), 1),
+                else_=0)).over(partition_by=pair)
+
+        ranked = select(
+            Message.user_a,
+            Message.user_b,
+            Message.id,
+            Message.timestamp,
+            db.func.row_number().over(
+                partition_by=pair,
+                order_by=(Message.timestamp.desc(), Message.id.desc()),
+            ).label("rank"),
+            unread_to(Message.user_a).label("unread_a"),
+            unread_to(Message.user_b).label("unread_b"),
+        ).subquery()
+
+        db.session.execute(db.delete(Conversation))
+        db.session.execute(
+            insert(Conversation).from_select(
+                ["user_a", "user_b", "last_message_id", "last_timestamp",
+                 "unread_a", "unread_b"],
+                select(ranked.c.user_a, ranked.c.user_b, ranked.c.id,
+                       ranked.c.timestamp, ranked.c.unread_a, ranked.c.unread_b)
+                .filter(ranked.c.rank == 1)))
+
+
+class FriendshipError(ValueError):
+    """A friendship request or status change that isn't allowed"""
+
 
 class Friendship(db.Model):
     """A pending, accepted, or rejected friendship between 2 Users"""
@@ -310,6 +1109,46 @@ class Friendship(db.Model):
         nullable=False
     )
 
+    # The two users in sorted order, filled in on insert; unique, so a pair
+    # has at most one friendship whichever of them sent the request
+    user_a = db.Column(
+        db.Text,
+        nullable=False,
+        default=_pair_default(min, "sender", "recipient")
+    )
+
+    user_b = db.Column(
+        db.Text,
+        nullable=False,
+        default=_pair_default(max, "sender", "recipient")
+    )
+
+    # Row version: bumped by every UPDATE, for ETag / Last-Modified
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow
+    )
+
+    # Cover both sides of User.friends; the trailing column lets each half of
+    # the UNION be answered from the index alone.
+    __table_args__ = (
+        db.Index('ix_friendships_sender_status', 'sender', 'status', 'recipient'),
+        db.Index('ix_friendships_recipient_status', 'recipient', 'status', 'sender'),
+        db.Index('ux_friendships_pair', 'user_a', 'user_b', unique=True),
+    )
+
+    # Status -> statuses it may change to; accepted and rejected are final
+    TRANSITIONS = {
+        "pending": {"accepted", "rejected"},
+        "accepted": set(),
+        "rejected": set(),
+    }
+
+    # Columns serialize() reads, in order; see select_serialized
+    serialized_columns = ("id", "sender", "recipient", "status")
+
     def serialize(self):
         """Serialize to dictionary"""
 
@@ -329,6 +1168,21 @@ class Friendship(db.Model):
 
         return friendships
 
+    @classmethod
+    def select_all(cls):
+        """Build a select for all friendships"""
+
+        return select(Friendship)
+
+    @classmethod
+    def accepted_pairs(cls):
+        """Return an iterator over (sender, recipient) of accepted friendships"""
+
+        return db.session.execute(
+            select(Friendship.sender, Friendship.recipient)
+            .filter(Friendship.status == "accepted")
+            .execution_options(yield_per=10000))
+
     @classmethod
     def get(cls, id):
         """Returns friendship by id"""
@@ -339,35 +1193,163 @@ class Friendship(db.Model):
 
     @classmethod
     def create(cls, sender, recipient):
-        """Create a friendship request"""
+        """Create a friendship request, or return the pair's existing one.
 
-        friendship = Friendship(
-            sender=sender,
-            recipient=recipient,
-            status="pending"
-        )
+        Idempotent under concurrent requests: the insert skips on the pair's
+        unique index, so a repeated or reversed request gets the row already
+        there (whatever its status) instead of a duplicate.
+        """
+
+        if sender == recipient:
+            raise FriendshipError("Can't send a friend request to yourself")
 
-        db.session.add(friendship)
+        user_a, user_b = conversation_pair(sender, recipient)
+        stmt = dialect_insert(Friendship)\
+            .values(sender=sender, recipient=recipient, status="pending",
+                    user_a=user_a, user_b=user_b)\
+            .on_conflict_do_nothing(
+                index_elements=[Friendship.user_a, Friendship.user_b])\
+            .returning(Friendship.id)
+        inserted = db.session.execute(stmt).scalar()
+
+        friendship = db.session.scalars(select(Friendship)
+            .filter_by(user_a=user_a, user_b=user_b)).one()
+
+        if inserted is not None:
+            publish_on_commit(
+                [sender, recipient], "friendship", friendship.serialize())
+            sync_friend_graph(friendship)
 
         return friendship
 
     @classmethod
     def change_status(cls, id, status):
-        """Change status of friendship request"""
+        """Change status of friendship request.
+
+        Raises FriendshipError unless TRANSITIONS allows the change;
+        setting the current status again is a no-op.
+        """
+
+        if status not in Friendship.TRANSITIONS:
+            raise FriendshipError(f"Unknown status: {status}")
 
         friendship = Friendship.query.get_or_404(id)
+
+        if status == friendship.status:
+            return friendship
+
+        if status not in Friendship.TRANSITIONS[friendship.status]:
+            raise FriendshipError(
+                f"Can't change friendship from {friendship.status} to {status}")
+
         friendship.status = status
+        publish_on_commit([friendship.sender, friendship.recipient],
+            "friendship", friendship.serialize())
+        sync_friend_graph(friendship)
 
         return friendship
 
 
+class UploadJob(db.Model):
+    """Status of a queued profile photo upload.
+
+    Kept in the database rather than by the process that accepted the
+    upload, so any server process can answer a status poll.
+    """
+
+    __tablename__ = 'upload_jobs'
+
+    id = db.Column(
+        db.Text,
+        primary_key=True
+    )
+
+    username = db.Column(
+        db.Text,
+        db.ForeignKey('users.username', ondelete='CASCADE'),
+        nullable=False
+    )
+
+    # "queued", "processing", then "done" or "failed"
+    status = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+    # Variant name -> stored URL, once done
+    urls = db.Column(
+        db.JSON
+    )
+
+    error = db.Column(
+        db.Text
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        index=True
+    )
+
+    FINAL_STATUSES = {"done", "failed"}
+
+    def serialize(self):
+        """Serialize to dictionary, leaving out urls and error until set"""
+
+        job = {
+            "id": self.id,
+            "username": self.username,
+            "status": self.status,
+        }
+        if self.urls is not None:
+            job["urls"] = self.urls
+        if self.error is not None:
+            job["error"] = self.error
+
+        return job
+
+    @classmethod
+    def create(cls, username):
+        """Add a queued job for username's photo"""
+
+        job = UploadJob(id=uuid.uuid4().hex, username=username, status="queued")
+        db.session.add(job)
+
+        return job
+
+    @classmethod
+    def set_status(cls, id, status, **changes):
+        """Update a job, if it still exists; once it's done or failed the
+        user's event stream gets an "upload" event on commit"""
+
+        job = db.session.get(UploadJob, id)
+        if job is None:
+            return None
+
+        job.status = status
+        for name, value in changes.items():
+            setattr(job, name, value)
+
+        if status in UploadJob.FINAL_STATUSES:
+            publish_on_commit([job.username], "upload", job.serialize())
+
+        return job
+
+    @classmethod
+    def prune(cls, before):
+        """Delete jobs last updated before the datetime 'before'"""
+
+        db.session.execute(delete(UploadJob).where(UploadJob.updated_at < before))
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. Queries need an app context:
+    requests and CLI commands have one, scripts push their own.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
 
@@ -0,0 +1,53 @@
+"""Keyset pagination helpers for Friender"""
+
+import base64
+import json
+from datetime import datetime
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class PaginationError(ValueError):
+    """Raised for an undecodable cursor or a non-numeric limit"""
+
+
+def encode_cursor(*values):
+    """Encode the sort key of the last row on a page as an opaque string"""
+
+    raw = json.dumps([
+        v.isoformat() if isinstance(v, datetime) else v for v in values
+    ])
+
+    return base64.urlsafe_b64encode(raw.encode("UTF-8")).decode("ascii")
+
+
+def decode_cursor(cursor, size):
+    """Decode a cursor made by encode_cursor into a list of 'size' values.
+
+    Datetimes come back as ISO strings; callers convert as needed.
+    """
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise PaginationError(f"Invalid cursor: {cursor}")
+
+    if not isinstance(values, list) or len(values) != size:
+        raise PaginationError(f"Invalid cursor: {cursor}")
+
+    return values
+
+
+def parse_limit(value, default=DEFAULT_LIMIT, maximum=MAX_LIMIT):
+    """Return page size from a query-string value, clamped to 1..maximum"""
+
+    if value is None:
+        return default
+
+    try:
+        limit = int(value)
+    except ValueError:
+        raise PaginationError(f"Invalid limit: {value}")
+
+    return max(1, min(limit, maximum))
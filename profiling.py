@@ -0,0 +1,204 @@
+"""Per-request SQL profiling: query counts, DB time and slow statements.
+
+A sampled share of requests (QUERY_PROFILE_SAMPLE_RATE) time every statement
+they run through SQLAlchemy engine events. Each sampled response gets a
+Server-Timing header (visible in browser dev tools) and one structured JSON
+log line on the "profiling" logger with the query count, total DB time, the
+slowest statements and the most repeated one (a repeat count that grows with
+page size is the mark of an N+1 lazy load).
+
+Statements slower than QUERY_PROFILE_SLOW_MS are explained on a background
+thread, off the request path, and the plan logged as a warning: EXPLAIN
+ANALYZE for SELECTs on PostgreSQL (which re-runs them), plain EXPLAIN for
+other statements, and EXPLAIN QUERY PLAN on SQLite. At most
+EXPLAIN_QUEUE_SIZE statements wait to be explained; past that they're
+skipped, so a burst of slow requests can't pile up work.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("profiling")
+
+# Longest statement text kept in logs
+STATEMENT_CHARS = 500
+
+# Slow statements queued or being explained before new ones are skipped
+EXPLAIN_QUEUE_SIZE = 20
+
+
+class RequestProfile:
+    """Statements run while handling one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = []
+
+    def record(self, engine, statement, parameters, executemany, seconds):
+        self.statements.append(
+            (seconds, engine, statement, parameters, executemany))
+
+    @property
+    def db_seconds(self):
+        return sum(s[0] for s in self.statements)
+
+    def slowest(self, n):
+        return sorted(self.statements, key=lambda s: s[0], reverse=True)[:n]
+
+    def most_repeated(self):
+        """Return (statement, count) for the most often run statement"""
+
+        counts = Counter(s[2] for s in self.statements)
+        return counts.most_common(1)[0] if counts else (None, 0)
+
+    def server_timing(self):
+        total = time.perf_counter() - self.started
+        return (f'db;desc="{len(self.statements)} queries";'
+                f"dur={self.db_seconds * 1000:.2f}, "
+                f"app;dur={total * 1000:.2f}")
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "query_profile" in g:
+        context.profile_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "profile_start", None)
+    if start is not None and has_request_context() and "query_profile" in g:
+        g.query_profile.record(conn.engine, statement, parameters, executemany,
+                               time.perf_counter() - start)
+
+
+def explain(engine, statement, parameters):
+    """Return the plan for a statement as a list of lines"""
+
+    if engine.dialect.name == "postgresql":
+        if statement.lstrip()[:6].upper() == "SELECT":
+            prefix = "EXPLAIN (ANALYZE, BUFFERS) "
+        else:
+            prefix = "EXPLAIN "
+    elif engine.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(prefix + statement, parameters).all()
+
+    return [" ".join(str(value) for value in row) for row in rows]
+
+
+class Explainer:
+    """Explains slow statements on one background thread"""
+
+    def __init__(self, queue_size=EXPLAIN_QUEUE_SIZE):
+        # Its thread only starts on the first submit, so each forked server
+        # worker gets its own
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="explain")
+        self._slots = threading.BoundedSemaphore(queue_size)
+
+    def submit(self, path, seconds, engine, statement, parameters):
+        """Queue a statement to be explained, unless the queue is full"""
+
+        if not self._slots.acquire(blocking=False):
+            logger.debug("Explain queue full, skipping slow statement")
+            return
+
+        try:
+            self._executor.submit(
+                self._explain, path, seconds, engine, statement, parameters)
+        except RuntimeError:
+            self._slots.release()
+            raise
+
+    def _explain(self, path, seconds, engine, statement, parameters):
+        try:
+            plan = explain(engine, statement, parameters)
+            logger.warning(json.dumps({
+                "path": path,
+                "ms": round(seconds * 1000, 2),
+                "statement": statement[:STATEMENT_CHARS],
+                "plan": plan,
+            }))
+        except Exception:
+            logger.exception("Couldn't explain slow statement")
+        finally:
+            self._slots.release()
+
+
+def log_profile(profile, response, config, explainer):
+    """Log one request's profile and queue its slow statements to be
+    explained"""
+
+    statement, repeats = profile.most_repeated()
+    logger.info(json.dumps({
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "duration_ms": round((time.perf_counter() - profile.started) * 1000, 2),
+        "queries": len(profile.statements),
+        "db_ms": round(profile.db_seconds * 1000, 2),
+        "slowest": [
+            {"ms": round(seconds * 1000, 2), "statement": text[:STATEMENT_CHARS]}
+            for seconds, _, text, _, _ in profile.slowest(config["QUERY_PROFILE_TOP"])
+        ],
+        "most_repeated": {
+            "count": repeats,
+            "statement": statement[:STATEMENT_CHARS] if statement else None,
+        },
+    }))
+
+    slow_ms = config["QUERY_PROFILE_SLOW_MS"]
+    if not slow_ms:
+        return
+
+    for seconds, engine, text, parameters, executemany in profile.statements:
+        if seconds * 1000 >= slow_ms and not executemany:
+            explainer.submit(request.path, seconds, engine, text, parameters)
+
+
+def init_app(app):
+    """Profile a sample of app's requests.
+
+    QUERY_PROFILE_SAMPLE_RATE is the share of requests profiled (0 turns
+    profiling off), QUERY_PROFILE_TOP how many of the slowest statements
+    are logged and QUERY_PROFILE_SLOW_MS the time over which a statement is
+    explained (0 never explains).
+    """
+
+    app.config.setdefault("QUERY_PROFILE_SAMPLE_RATE", 0.0)
+    app.config.setdefault("QUERY_PROFILE_TOP", 3)
+    app.config.setdefault("QUERY_PROFILE_SLOW_MS", 100.0)
+
+    app.extensions["profiling"] = Explainer()
+
+    # Engine-wide, so replica binds are covered too
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    @app.before_request
+    def start_profile():
+        rate = app.config["QUERY_PROFILE_SAMPLE_RATE"]
+        if rate > 0 and random.random() < rate:
+            g.query_profile = RequestProfile()
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop("query_profile", None)
+        if profile is not None:
+            response.headers["Server-Timing"] = profile.server_timing()
+            log_profile(profile, response, app.config, app.extensions["profiling"])
+        return response
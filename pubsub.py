@@ -0,0 +1,260 @@
+"""Publish/subscribe fan-out for pushing events to connected clients.
+
+Events are dicts published to a channel (Friender uses one per username).
+Brokers:
+
+- MemoryBroker ("memory://"): in-process; subscribers only see events
+  published by the same process, so it suits a single server process
+- RedisBroker ("redis://..."): publishes through Redis pub/sub, so every
+  server process sees every event; needs the `redis` package, and accepts
+  any client with redis-py's interface (e.g. fakeredis) for local testing
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """A subscriber's queue of events.
+
+    The queue is bounded; a subscriber that falls behind loses its oldest
+    events rather than growing without limit. Threads wait with get,
+    asyncio tasks with get_async.
+    """
+
+    __slots__ = ("broker", "channels", "_events", "_ready", "_waiter")
+
+    def __init__(self, broker, channels, maxsize):
+        self.broker = broker
+        self.channels = channels
+        self._events = deque(maxlen=maxsize)
+        self._ready = threading.Condition(threading.Lock())
+        # (event loop, future) of a pending get_async
+        self._waiter = None
+
+    def put(self, event):
+        with self._ready:
+            self._events.append(event)
+            self._ready.notify()
+            if self._waiter is not None:
+                loop, ready = self._waiter
+                loop.call_soon_threadsafe(_resolve, ready)
+
+    def get(self, timeout=None):
+        """Return the next event, or None if none arrives within timeout"""
+
+        with self._ready:
+            if not self._events:
+                self._ready.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+    async def get_async(self, timeout=None):
+        """Coroutine version of get: waits on the event loop rather than
+        holding a thread"""
+
+        with self._ready:
+            if self._events:
+                return self._events.popleft()
+            loop = asyncio.get_running_loop()
+            ready = loop.create_future()
+            self._waiter = (loop, ready)
+
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._ready:
+                self._waiter = None
+
+        with self._ready:
+            return self._events.popleft() if self._events else None
+
+    def close(self):
+        """Stop receiving events"""
+
+        self.broker.unsubscribe(self)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class MemoryBroker:
+    """Fans events out to subscribers in this process"""
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels):
+        """Return a Subscription receiving events on any of 'channels'"""
+
+        subscription = Subscription(self, tuple(channels), self.maxsize)
+
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[channel]
+
+    def publish(self, channel, event):
+        """Deliver event to this process's subscribers of channel"""
+
+        with self._lock:
+            subscribers = tuple(self._subscribers.get(channel, ()))
+
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def stats(self):
+        """Return channel and subscription counts"""
+
+        with self._lock:
+            return {
+                "channels": len(self._subscribers),
+                "subscriptions": sum(len(s) for s in self._subscribers.values()),
+            }
+
+
+class RedisBroker(MemoryBroker):
+    """Fans events out through Redis pub/sub to every server process.
+
+    Each process keeps a single Redis subscription (one listener thread) and
+    hands what it receives to its local subscribers, so idle clients cost no
+    Redis connections. If the subscription fails, the listener reconnects
+    with exponential backoff (events published meanwhile are lost); once no
+    local subscribers are left it stops, and the next subscribe starts a new
+    one.
+    """
+
+    # Seconds before the first reconnect attempt, doubled up to the max
+    RECONNECT_DELAY = 0.5
+    RECONNECT_MAX_DELAY = 30
+
+    def __init__(self, client, prefix="friender:", maxsize=100):
+        super().__init__(maxsize)
+        self.client = client
+        self.prefix = prefix
+        self._listener = None
+
+    def subscribe(self, channels):
+        subscription = super().subscribe(channels)
+
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, daemon=True)
+                self._listener.start()
+
+        return subscription
+
+    def publish(self, channel, event):
+        self.client.publish(self.prefix + channel, json.dumps(event))
+
+    def _listen(self):
+        delay = self.RECONNECT_DELAY
+
+        try:
+            while True:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                try:
+                    pubsub.psubscribe(self.prefix + "*")
+                    delay = self.RECONNECT_DELAY
+                    for message in pubsub.listen():
+                        self._deliver(message)
+                except Exception:
+                    logger.exception(
+                        "Redis subscription failed, reconnecting in %.1fs", delay)
+                finally:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+                with self._lock:
+                    if not self._subscribers:
+                        self._listener = None
+                        return
+
+                time.sleep(delay)
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+        finally:
+            with self._lock:
+                if self._listener is threading.current_thread():
+                    self._listener = None
+
+    def _deliver(self, message):
+        channel = message["channel"]
+        if isinstance(channel, bytes):
+            channel = channel.decode("UTF-8")
+
+        try:
+            event = json.loads(message["data"])
+        except ValueError:
+            logger.warning("Dropped malformed event on %s", channel)
+            return
+
+        super().publish(channel[len(self.prefix):], event)
+
+
+def create_broker(url, maxsize=100):
+    """Return the broker for a PUBSUB_URL"""
+
+    if url.startswith("memory://"):
+        return MemoryBroker(maxsize)
+
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        import redis
+        return RedisBroker(redis.Redis.from_url(url), maxsize=maxsize)
+
+    raise ValueError(f"Unsupported PUBSUB_URL: {url}")
+
+
+class PubSub:
+    """Flask extension holding the configured broker.
+
+    Config:
+    - PUBSUB_URL: "memory://" (default) or a redis:// URL
+    - PUBSUB_QUEUE_SIZE: events buffered per subscriber
+    """
+
+    def __init__(self, app=None):
+        self.broker = MemoryBroker()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.setdefault("PUBSUB_URL", "memory://")
+        maxsize = app.config.setdefault("PUBSUB_QUEUE_SIZE", 100)
+
+        self.broker = create_broker(url, maxsize)
+        app.extensions["pubsub"] = self
+
+    def subscribe(self, channels):
+        return self.broker.subscribe(channels)
+
+    def publish(self, channel, event):
+        """Publish, logging rather than raising if the broker is down"""
+
+        try:
+            self.broker.publish(channel, event)
+        except Exception:
+            logger.exception("Couldn't publish event to %s", channel)
@@ -0,0 +1,316 @@
+"""Token-bucket rate limiting for write routes.
+
+Each client gets a bucket per budget (e.g. "messages"): it holds up to
+'burst' tokens, refills at 'rate' per second and each request takes one, or
+one per item for batch routes (POST /messages/bulk spends a
+"messages_bulk" token per message it creates, a budget sized for broadcast
+batches). Clients are keyed by JWT identity when they send a valid token,
+otherwise by IP; behind a reverse proxy, set TRUSTED_PROXY_HOPS so that is
+the client's address and not the proxy's. An empty bucket raises
+RateLimited, answered with 429 and a Retry-After of when the next token
+arrives.
+
+Stores (RATELIMIT_STORAGE_URL):
+
+- MemoryStore ("memory://"): per process; under several server workers each
+  allows the full budget
+- SharedMemoryStore ("mmap:///path/to/file"): a fixed table of buckets in a
+  memory-mapped file, shared by every process that opens it (e.g. forked
+  gunicorn workers), so budgets hold across workers. Keys hash to slots; a
+  key landing on another key's slot starts with a full bucket, so
+  collisions only ever err towards allowing
+
+Taking a token is a dict lookup or a slot read and write under a lock
+(plus an fcntl record lock for the shared store), and each distinct JWT is
+verified only once: a few microseconds per request.
+"""
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
+
+from cache import MISSING, TTLCache
+
+# Budget name -> "count/period" (period one of second, minute, hour), e.g.
+# 60 requests a minute, refilled continuously with a burst of 60
+DEFAULT_LIMITS = {
+    "messages": "60/minute",
+    "messages_bulk": "10000/hour",
+    "friendships": "20/minute",
+}
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600}
+
+
+class RateLimited(Exception):
+    """Raised when a client's bucket for a budget is empty.
+
+    'retry_after' is None when the request costs more than the bucket holds,
+    so no wait would let it through.
+    """
+
+    def __init__(self, retry_after):
+        if retry_after is None:
+            super().__init__("Request exceeds the rate limit's burst")
+        else:
+            super().__init__(f"Rate limited, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def parse_limit(value):
+    """Return (rate per second, burst) for a "count/period" string"""
+
+    try:
+        count, period = value.split("/")
+        count = float(count)
+        seconds = PERIODS[period.strip()]
+    except (KeyError, ValueError):
+        raise ValueError(f"Invalid rate limit: {value}")
+
+    return count / seconds, count
+
+
+def refill(tokens, updated, now, rate, burst, cost):
+    """Return (allowed, tokens left, seconds until 'cost' tokens are there)"""
+
+    tokens = min(burst, tokens + (now - updated) * rate)
+
+    if tokens >= cost:
+        return True, tokens - cost, 0.0
+
+    return False, tokens, (cost - tokens) / rate
+
+
+class MemoryStore:
+    """Buckets in a dict in this process, least recently used dropped past
+    'maxsize'"""
+
+    def __init__(self, maxsize=100000, clock=time.time):
+        self.maxsize = maxsize
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        """Take 'cost' tokens from key's bucket; return (allowed, retry_after)"""
+
+        now = self._clock()
+
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            allowed, tokens, retry_after = refill(
+                tokens, updated, now, rate, burst, cost)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+
+        return allowed, retry_after
+
+
+class SharedMemoryStore:
+    """Buckets in a memory-mapped file shared between processes.
+
+    Each of 'slots' slots holds (key hash, tokens, updated). Threads of one
+    process serialize on striped locks; processes on fcntl record locks of
+    the slot's bytes. The file is opened on first use, so each forked worker
+    maps it itself.
+    """
+
+    SLOT = struct.Struct("=Qdd")
+    STRIPES = 64
+
+    def __init__(self, path, slots=65536, clock=time.time):
+        self.path = path
+        self.slots = slots
+        self._clock = clock
+        self._locks = [threading.Lock() for _ in range(self.STRIPES)]
+        self._open_lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        with self._open_lock:
+            if self._pid == os.getpid():
+                return
+
+            size = self.slots * self.SLOT.size
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+
+            self._fd = fd
+            self._map = mmap.mmap(fd, size)
+            self._pid = os.getpid()
+
+    def take(self, key, rate, burst, cost=1):
+        """Take 'cost' tokens from key's bucket; return (allowed, retry_after)"""
+
+        if self._pid != os.getpid():
+            self._open()
+
+        digest = int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+        slot = digest % self.slots
+        offset = slot * self.SLOT.size
+        now = self._clock()
+
+        with self._locks[slot % self.STRIPES]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                stored, tokens, updated = self.SLOT.unpack_from(self._map, offset)
+                if stored != digest:
+                    tokens, updated = burst, now
+                allowed, tokens, retry_after = refill(
+                    tokens, updated, now, rate, burst, cost)
+                self.SLOT.pack_into(self._map, offset, digest, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+
+        return allowed, retry_after
+
+
+def create_store(url):
+    """Return the store for a RATELIMIT_STORAGE_URL"""
+
+    if url.startswith("memory://"):
+        return MemoryStore()
+
+    if url.startswith("mmap://"):
+        return SharedMemoryStore(url[len("mmap://"):])
+
+    raise ValueError(f"Unsupported RATELIMIT_STORAGE_URL: {url}")
+
+
+def token_identity(token, cache):
+    """Return the identity a bearer token was issued to, or None.
+
+    Verifying a JWT costs a few hundred microseconds, so results (None for
+    invalid tokens) are kept in 'cache' and each distinct token is verified
+    once; a token only ever maps to the identity it was signed for, so
+    reusing the result (even past the token's expiry) can't misattribute a
+    request.
+    """
+
+    identity = cache.get(token)
+
+    if identity is MISSING:
+        try:
+            claims = decode_token(token)
+            identity = claims[current_app.config["JWT_IDENTITY_CLAIM"]]
+        except (JWTExtendedException, PyJWTError, KeyError):
+            identity = None
+        cache.set(token, identity)
+
+    return identity
+
+
+def client_key(cache):
+    """Return "user:<identity>" for a request with a valid JWT, else
+    "ip:<address>"; a bad token just falls back to the IP"""
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    identity = token_identity(token, cache) if scheme == "Bearer" and token else None
+
+    if identity is not None:
+        return f"user:{identity}"
+
+    return f"ip:{request.remote_addr}"
+
+
+class RateLimiter:
+    """Flask extension applying per-route token-bucket budgets; each app
+    gets its own (see rate_limit).
+
+    Config:
+    - RATELIMIT_ENABLED: False lets every request through
+    - RATELIMIT_STORAGE_URL: "memory://" (default) or "mmap:///path"
+    - RATELIMITS: {budget name: "count/period"}, over DEFAULT_LIMITS
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.store = MemoryStore()
+        self.limits = {name: parse_limit(value)
+                       for name, value in DEFAULT_LIMITS.items()}
+        # Bearer token -> identity, see token_identity
+        self.identities = TTLCache(maxsize=10000, ttl=300)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.setdefault("RATELIMIT_ENABLED", True)
+        url = app.config.setdefault("RATELIMIT_STORAGE_URL", "memory://")
+        limits = dict(DEFAULT_LIMITS, **app.config.setdefault("RATELIMITS", {}))
+
+        self.store = create_store(url)
+        self.limits = {name: parse_limit(value) for name, value in limits.items()}
+        app.extensions["rate_limiter"] = self
+
+    def hit(self, name, key, cost=1):
+        """Take 'cost' tokens from key's bucket for budget 'name', or raise
+        RateLimited"""
+
+        if name not in self.limits:
+            raise ValueError(f"Unknown rate limit: {name}")
+
+        rate, burst = self.limits[name]
+        if cost > burst:
+            raise RateLimited(None)
+
+        allowed, retry_after = self.store.take(f"{name}:{key}", rate, burst, cost)
+
+        if not allowed:
+            raise RateLimited(retry_after)
+
+    def max_cost(self, name, default):
+        """Return the most a single request may spend of budget 'name': its
+        burst, or 'default' if that's lower or limiting is off"""
+
+        if not self.enabled:
+            return default
+
+        return min(default, int(self.limits[name][1]))
+
+    def spend(self, name, cost=1):
+        """Charge the current request's client 'cost' tokens of budget
+        'name', e.g. one per item of a batch"""
+
+        if self.enabled:
+            self.hit(name, client_key(self.identities), cost)
+
+
+def rate_limit(name):
+    """Decorate a view to spend one token of the current app's budget
+    'name' per request"""
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            current_app.extensions["rate_limiter"].spend(name)
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def retry_after_header(retry_after):
+    """Retry-After value (whole seconds, at least 1) for a RateLimited"""
+
+    return str(max(1, math.ceil(retry_after)))
@@ -0,0 +1,165 @@
+"""Route read-only requests to database replicas.
+
+Replica URLs become Flask-SQLAlchemy binds ("replica_0", "replica_1", ...).
+Views marked with @read_only run their queries against one replica, picked
+per request round robin or by fewest checked out connections. Everything
+else, and any session that has pending changes, uses the primary.
+
+Replicas lag the primary, so a client that just wrote is kept on the
+primary for DB_REPLICA_STICKY_SECONDS, keyed by JWT identity and by remote
+address. That memory is per process: with several server workers keep the
+window above the expected replication lag and rely on it rather than on
+stickiness alone.
+
+To try it locally point DATABASE_URL and DATABASE_REPLICA_URLS at two SQLite
+files (copy the first to the second after creating tables).
+"""
+
+import itertools
+import threading
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+from cache import MISSING, TTLCache
+
+
+class ReplicaRouter:
+    """Picks replica engines and remembers which clients recently wrote"""
+
+    def __init__(self):
+        self.bind_keys = []
+        self.selection = "round_robin"
+        self.recent_writers = TTLCache(maxsize=0, ttl=0)
+        self._next = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Add replica binds to app config.
+
+        Must run before the database is connected to app.
+        """
+
+        urls = app.config.setdefault("DB_REPLICA_URLS", [])
+        self.selection = app.config.setdefault("DB_REPLICA_SELECTION", "round_robin")
+        sticky = app.config.setdefault("DB_REPLICA_STICKY_SECONDS", 5)
+
+        if self.selection not in ("round_robin", "least_loaded"):
+            raise ValueError(f"Unknown DB_REPLICA_SELECTION: {self.selection}")
+
+        self.bind_keys = [f"replica_{i}" for i in range(len(urls))]
+        self._next = itertools.cycle(self.bind_keys)
+        self.recent_writers = TTLCache(maxsize=100000 if urls else 0, ttl=sticky)
+
+        binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+        binds.update(zip(self.bind_keys, urls))
+
+        app.extensions["replicas"] = self
+
+    def choose(self, engines):
+        """Return the bind key of the replica to use"""
+
+        if self.selection == "least_loaded":
+            return min(self.bind_keys,
+                       key=lambda key: _checked_out(engines[key].pool))
+
+        with self._lock:
+            return next(self._next)
+
+    def mark_write(self):
+        """Keep this request's client on the primary for a while"""
+
+        for key in _client_keys():
+            self.recent_writers.set(key, True)
+
+    def is_sticky(self):
+        return any(self.recent_writers.get(key) is not MISSING
+                   for key in _client_keys())
+
+    def stats(self, engines):
+        return {
+            "selection": self.selection,
+            "replicas": {key: _checked_out(engines[key].pool)
+                         for key in self.bind_keys},
+            "recent_writers": self.recent_writers.stats()["size"],
+        }
+
+
+def _checked_out(pool):
+    """Connections in use from pool (0 for pools that don't count them)"""
+
+    checkedout = getattr(pool, "checkedout", None)
+    return checkedout() if checkedout else 0
+
+
+def _client_keys():
+    """Return the current client's identity and address keys"""
+
+    keys = [f"ip:{request.remote_addr}"]
+
+    try:
+        identity = get_jwt_identity()
+    except RuntimeError:
+        identity = None
+
+    if identity is not None:
+        keys.append(f"user:{identity}")
+
+    return keys
+
+
+def read_only(f):
+    """Run a view's queries against a replica.
+
+    Apply below @jwt_required so the caller's identity is known when
+    deciding whether they must stay on the primary.
+    """
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        router = current_app.extensions.get("replicas")
+
+        if router and router.bind_keys and not router.is_sticky():
+            g.db_replica = router.choose(current_app.extensions["sqlalchemy"].engines)
+
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+class RoutingSession(Session):
+    """Session sending read-only requests' queries to their replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and has_request_context() and "db_replica" in g
+                and not (self._flushing or self.new or self.dirty or self.deleted)):
+            return self._db.engines[g.db_replica]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _flushed(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def _executed(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _committed(session):
+    if session.info.pop("wrote", False) and has_request_context():
+        router = current_app.extensions.get("replicas")
+        if router and router.bind_keys:
+            router.mark_write()
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _rolled_back(session):
+    session.info.pop("wrote", None)
@@ -0,0 +1,157 @@
+"""Full-text search over user bios and message texts.
+
+On PostgreSQL each searchable table gets a tsvector column with a GIN index,
+kept current by a trigger; on SQLite (for local use) an FTS5 table over the
+same rows, kept current by triggers. Either way writes need no extra round
+trip. The DDL runs when create_all creates the tables; for existing
+databases run 'flask create-search-index'.
+"""
+
+import re
+
+from sqlalchemy import (
+    DDL, Float, cast, column, event, func, literal_column, or_, select, table,
+    text, tuple_
+)
+
+from models import Message, User, db, select_serialized
+from pagination import DEFAULT_LIMIT, PaginationError, decode_cursor, encode_cursor
+
+LANGUAGE = "pg_catalog.english"
+
+
+class SearchIndex:
+    """Full-text index over one text column of a model"""
+
+    def __init__(self, model, field):
+        self.model = model
+        self.field = field
+        self.table = model.__tablename__
+        self.key = model.__mapper__.primary_key[0]
+        self.fts = f"{self.table}_fts"
+
+    def postgresql_ddl(self):
+        t, f = self.table, self.field
+        return [
+            f"ALTER TABLE {t} ADD COLUMN IF NOT EXISTS search_vector tsvector",
+            f"CREATE INDEX IF NOT EXISTS ix_{t}_search ON {t} USING GIN (search_vector)",
+            f"DROP TRIGGER IF EXISTS {t}_search_update ON {t}",
+            f"CREATE TRIGGER {t}_search_update BEFORE INSERT OR UPDATE OF {f} ON {t} "
+            f"FOR EACH ROW EXECUTE PROCEDURE "
+            f"tsvector_update_trigger(search_vector, '{LANGUAGE}', {f})",
+        ]
+
+    def sqlite_ddl(self):
+        t, f, fts = self.table, self.field, self.fts
+        insert = f"INSERT INTO {fts}(rowid, {f}) VALUES (new.rowid, new.{f});"
+        delete = f"INSERT INTO {fts}({fts}, rowid, {f}) VALUES ('delete', old.rowid, old.{f});"
+        return [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} "
+            f"USING fts5({f}, content='{t}', content_rowid='rowid')",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {t} "
+            f"BEGIN {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {t} "
+            f"BEGIN {delete} END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {f} ON {t} "
+            f"BEGIN {delete} {insert} END",
+        ]
+
+    def register_ddl(self):
+        """Create the index along with the table, and drop the SQLite FTS
+        table with it"""
+
+        target = self.model.__table__
+        for statement in self.postgresql_ddl():
+            event.listen(target, "after_create",
+                         DDL(statement).execute_if(dialect="postgresql"))
+        for statement in self.sqlite_ddl():
+            event.listen(target, "after_create",
+                         DDL(statement).execute_if(dialect="sqlite"))
+        event.listen(target, "before_drop",
+                     DDL(f"DROP TABLE IF EXISTS {self.fts}").execute_if(dialect="sqlite"))
+
+    def create(self):
+        """Add the index to an existing table and fill it in"""
+
+        dialect = db.engine.dialect.name
+        statements = self.postgresql_ddl() if dialect == "postgresql" \
+            else self.sqlite_ddl()
+
+        for statement in statements:
+            db.session.execute(DDL(statement))
+
+        if dialect == "postgresql":
+            db.session.execute(text(
+                f"UPDATE {self.table} SET search_vector = "
+                f"to_tsvector('{LANGUAGE}', coalesce({self.field}, '')) "
+                f"WHERE search_vector IS NULL"))
+        else:
+            db.session.execute(text(
+                f"INSERT INTO {self.fts}({self.fts}) VALUES ('rebuild')"))
+
+    def search(self, q, *filters, after=None, limit=DEFAULT_LIMIT):
+        """Return a page of rows matching 'q', best match first.
+
+        Rows hold the model's serialized columns, then 'rank' (higher is
+        better). 'after' is a cursor from SearchIndex.cursor.
+        """
+
+        if db.session.get_bind().dialect.name == "postgresql":
+            query = func.websearch_to_tsquery(LANGUAGE, q)
+            vector = literal_column(f"{self.table}.search_vector")
+            # ts_rank is a float4; as a float8 it compares exactly with the
+            # cursor's JSON number, so no row repeats across pages
+            rank = cast(func.ts_rank(vector, query), Float(53))
+            stmt = select(self.model).filter(vector.op("@@")(query))
+        else:
+            terms = re.findall(r"\w+", q)
+            if not terms:
+                return []
+            fts = table(self.fts, column("rowid"))
+            # bm25 is lower for better matches
+            rank = -func.bm25(literal_column(self.fts))
+            stmt = select(self.model)\
+                .join(fts, fts.c.rowid == literal_column(f"{self.table}.rowid"))\
+                .filter(literal_column(self.fts).op("MATCH")(
+                    " ".join(f'"{term}"' for term in terms)))
+
+        stmt = stmt.filter(*filters).order_by(rank.desc(), self.key.desc())
+
+        if after is not None:
+            last_rank, last_key = decode_cursor(after, 2)
+            # The key must be the column's type (a username, a message id)
+            if isinstance(last_rank, bool) or isinstance(last_key, bool) or \
+                    not isinstance(last_rank, (int, float)) or \
+                    not isinstance(last_key, self.key.type.python_type):
+                raise PaginationError(f"Invalid cursor: {after}")
+            stmt = stmt.filter(tuple_(rank, self.key) < tuple_(last_rank, last_key))
+
+        stmt = select_serialized(stmt, self.model, rank.label("rank"))
+
+        return db.session.execute(stmt.limit(limit)).all()
+
+    def cursor(self, row):
+        """Return the cursor that continues after search result 'row'"""
+
+        return encode_cursor(row.rank, getattr(row, self.key.key))
+
+
+user_search = SearchIndex(User, "bio")
+message_search = SearchIndex(Message, "text")
+
+user_search.register_ddl()
+message_search.register_ddl()
+
+
+def search_users(q, after=None, limit=DEFAULT_LIMIT):
+    """Return a page of users whose bio matches 'q'"""
+
+    return user_search.search(q, after=after, limit=limit)
+
+
+def search_messages(q, username, after=None, limit=DEFAULT_LIMIT):
+    """Return a page of messages sent or received by username matching 'q'"""
+
+    return message_search.search(
+        q, or_(Message.from_user == username, Message.to_user == username),
+        after=after, limit=limit)
@@ -1,11 +1,17 @@
-"""Seed test users, messages, and friendships"""
+"""Seed a few fixed test users, messages, and friendships.
+
+For load-testing volumes use 'flask generate-data' (see datagen.py).
+"""
 import random
-from app import db
-from models import User, Message, Friendship
+from app import create_app
+from models import db, User, Message, Conversation, Friendship
 from faker import Faker
 
 fake = Faker()
 
+app = create_app()
+app.app_context().push()
+
 RANDOM_TIMESTAMPS = ["2021-02-12 06:41:25.698388",
 "2022-11-07 11:30:08.462462",
 "2022-12-25 23:07:30.426382",
@@ -101,6 +107,9 @@ message3 = Message(
 db.session.add_all([message1, message2, message3])
 db.session.commit()
 
+Conversation.rebuild()
+db.session.commit()
+
 # seed friendships
 
 friendship1 = Friendship(
@@ -147,8 +156,8 @@ friendship6 = Friendship(
 
 friendship7 = Friendship(
     id = 7,
-    sender = user4.username,
-    recipient = "jdawg",
+    sender = user5.username,
+    recipient = user2.username,
     status = "accepted"
 )
 
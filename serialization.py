@@ -0,0 +1,57 @@
+"""Fast encoding of list responses.
+
+List routes fetch plain rows with models.select_serialized, build dicts from
+them with records() and encode with orjson when it's installed (falling
+back to the json module). Clients sending 'Accept: application/msgpack' get
+MessagePack instead when msgpack is installed.
+"""
+
+import json
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+
+def records(rows, fields):
+    """Return a dict per row, of its first len(fields) values by name"""
+
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def dumps(obj):
+    """Encode obj as compact JSON bytes"""
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def negotiate():
+    """Return the mimetype respond() will use for this request"""
+
+    offered = [JSON, MSGPACK] if msgpack is not None else [JSON]
+
+    return request.accept_mimetypes.best_match(offered, default=JSON)
+
+
+def respond(payload, status=200):
+    """Return payload as a JSON response, or MessagePack if the client
+    prefers it and msgpack is installed"""
+
+    if negotiate() == MSGPACK:
+        return Response(msgpack.packb(payload), status, mimetype=MSGPACK)
+
+    return Response(dumps(payload), status, mimetype=JSON)
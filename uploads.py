@@ -0,0 +1,244 @@
+"""Profile photo processing and storage, off the request thread.
+
+The upload route spools the file and queues a job; a small worker pool
+resizes it into JPEG variants, stores each one and then points User.photo at
+the main variant. Job statuses live in the upload_jobs table (UploadJob),
+so any server process can report them. Storage is S3 (streamed in multipart chunks) or a local
+directory, which is handy for development and tests.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+from io import BytesIO
+
+from metrics import photo_upload_bytes, photo_upload_seconds
+from models import UploadJob, User, db
+
+# Variant name -> longest edge in pixels. The "" variant keeps the original
+# profile_photos/<username>_photo.jpeg key and is what User.photo points at.
+VARIANTS = {
+    "": 1024,
+    "medium": 512,
+    "thumb": 128,
+}
+
+JPEG_QUALITY = 85
+CHUNK_SIZE = 8 * 1024 * 1024
+SPOOL_SIZE = 1024 * 1024
+
+# Job statuses are deleted this long after their last change
+JOB_RETENTION = timedelta(days=1)
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """Return a boto3 S3 client shared by the process, created on first use.
+
+    Importing boto3 and building a client takes hundreds of milliseconds, so
+    workers that never touch S3 never pay for it.
+    """
+
+    import boto3
+
+    return boto3.client("s3")
+
+
+class S3Storage:
+    """Stores objects in an S3 bucket, uploading large ones in parts.
+
+    Without an explicit client, uses get_s3_client() on first access.
+    """
+
+    name = "s3"
+
+    def __init__(self, bucket, client=None):
+        self.bucket = bucket
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_s3_client()
+        return self._client
+
+    def save(self, key, fileobj, content_type):
+        from boto3.s3.transfer import TransferConfig
+
+        self.client.upload_fileobj(
+            fileobj, self.bucket, key,
+            ExtraArgs={"ContentType": content_type},
+            Config=TransferConfig(
+                multipart_threshold=CHUNK_SIZE, multipart_chunksize=CHUNK_SIZE))
+
+    def url(self, key):
+        return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+
+    def presigned_post(self, key, content_type, max_bytes, expires):
+        """Return {url, fields} letting a client POST one object straight to
+        'key', limited to 'content_type' and at most 'max_bytes'"""
+
+        return self.client.generate_presigned_post(
+            Bucket=self.bucket,
+            Key=key,
+            Fields={"Content-Type": content_type},
+            Conditions=[
+                {"Content-Type": content_type},
+                ["content-length-range", 1, max_bytes],
+            ],
+            ExpiresIn=expires)
+
+    def head(self, key):
+        """Return (size, content type) of a stored object, or None"""
+
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+
+        return head["ContentLength"], head.get("ContentType")
+
+
+class FilesystemStorage:
+    """Stores objects as files under a local directory"""
+
+    name = "filesystem"
+
+    def __init__(self, root, base_url):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+
+    def save(self, key, fileobj, content_type):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "wb") as f:
+            shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+
+    def url(self, key):
+        return f"{self.base_url}/{key}"
+
+    def presigned_post(self, key, content_type, max_bytes, expires):
+        raise NotImplementedError("Direct uploads need the s3 backend")
+
+    def head(self, key):
+        path = os.path.join(self.root, key)
+        if not os.path.exists(path):
+            return None
+
+        return os.path.getsize(path), "image/jpeg"
+
+
+def resize(fileobj):
+    """Return {variant: JPEG bytes} for every entry in VARIANTS.
+
+    Raises PIL.UnidentifiedImageError if fileobj isn't an image.
+    """
+
+    from PIL import Image, ImageOps
+
+    with Image.open(fileobj) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+
+        variants = {}
+        for name, size in VARIANTS.items():
+            variant = image.copy()
+            variant.thumbnail((size, size))
+
+            out = BytesIO()
+            variant.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True,
+                         progressive=True)
+            variants[name] = out.getvalue()
+
+    return variants
+
+
+def photo_key(prefix, username, variant):
+    suffix = f"_{variant}" if variant else ""
+    return f"{prefix}/{username}_photo{suffix}.jpeg"
+
+
+class PhotoPipeline:
+    """Queue of photo jobs processed by a background thread pool.
+
+    Jobs are UploadJob rows, added when queued and updated (in their own
+    app contexts) as the workers go; jobs older than JOB_RETENTION are
+    pruned as new ones arrive.
+    """
+
+    def __init__(self, app, storage, prefix, workers=2):
+        self.app = app
+        self.storage = storage
+        self.prefix = prefix
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="photo-upload")
+
+    def submit(self, username, fileobj):
+        """Spool fileobj and queue it for processing; return the job id"""
+
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        shutil.copyfileobj(fileobj, spool, 64 * 1024)
+        spool.seek(0)
+
+        # A fresh app context, so committing the job leaves the caller's
+        # session alone
+        with self.app.app_context():
+            UploadJob.prune(datetime.utcnow() - JOB_RETENTION)
+            job_id = UploadJob.create(username).id
+            db.session.commit()
+
+        self.executor.submit(self._process, job_id, username, spool)
+
+        return job_id
+
+    def status(self, job_id):
+        """Return a job's serialized status, or None"""
+
+        job = db.session.get(UploadJob, job_id)
+
+        return job.serialize() if job else None
+
+    def _update(self, job_id, status, **changes):
+        with self.app.app_context():
+            UploadJob.set_status(job_id, status, **changes)
+            db.session.commit()
+
+    def _process(self, job_id, username, spool):
+        from PIL import UnidentifiedImageError
+
+        self._update(job_id, "processing")
+
+        try:
+            with spool:
+                variants = resize(spool)
+
+            urls = {}
+            for name, data in variants.items():
+                key = photo_key(self.prefix, username, name)
+                start = time.perf_counter()
+                self.storage.save(key, BytesIO(data), "image/jpeg")
+                photo_upload_seconds.labels(self.storage.name).observe(
+                    time.perf_counter() - start)
+                photo_upload_bytes.labels(self.storage.name).observe(len(data))
+                urls[name or "photo"] = self.storage.url(key)
+
+            # The photo and the job's "done" commit together
+            with self.app.app_context():
+                User.update(username=username, data={"photo": urls["photo"]})
+                UploadJob.set_status(job_id, "done", urls=urls)
+                db.session.commit()
+
+        except UnidentifiedImageError:
+            self._update(job_id, "failed", error="Not an image")
+
+        except Exception as e:
+            self.app.logger.exception("Photo upload %s failed", job_id)
+            self._update(job_id, "failed", error=str(e))